@@ -3,21 +3,39 @@ from flask_login import LoginManager, login_required, current_user
 from datetime import datetime, timedelta
 import pytz
 import threading
-import time
+
+import click
 
 from dotenv import load_dotenv
 from config import Config
 
 from models.base import db
+from models.esquema import asegurar_esquema
 from models.usuario import Usuario, bcrypt
-from models.movimiento import MovimientoBarco
+from models.movimiento import (
+    recalcular_vencimientos,
+    completar_duraciones,
+)
 
-from models.tiempo import ConfigTiempos
-from models.operacion import Operacion
+from models.tiempo import tiempos_cache
+from models.resumen_transito import (
+    reconstruir_resumen_transito,
+    llenar_resumen_si_vacio,
+)
 
+from models.registro_viajes import registro_viajes
+from models.notificacion_outbox import drenar_outbox, despertar_despacho
+from models.push_envio import guardar_estado_suscripciones
+from models.programador import (
+    LiderAlertas,
+    evaluacion_exclusiva,
+    REINTENTO_LIDER_SEGUNDOS,
+)
 from routes.notificacion_routes import (
-    guardar_ultima_alerta,
-    enviar_push_mismo_mensaje,
+    evaluar_viajes_vencidos,
+    hay_viajes_por_evaluar,
+    RECARGA_REGISTRO_SEGUNDOS,
+    REVISION_REGISTRO_SEGUNDOS,
 )
 
 # Blueprints
@@ -91,6 +109,23 @@ def create_app():
     app.register_blueprint(usuario_bp)
     app.register_blueprint(tiempos_bp)
 
+    @app.cli.command("asegurar-esquema")
+    def asegurar_esquema_cli():
+        """Crea tablas nuevas y aplica índices y columnas pendientes."""
+        if asegurar_esquema():
+            print("✅ Esquema al día.")
+        else:
+            print("⚠️ Otro proceso está aplicando el esquema; intente de nuevo.")
+
+    @app.cli.command("reconstruir-resumen-transito")
+    def reconstruir_resumen_transito_cli():
+        """Recalcula el resumen por placa del reporte de choferes en tránsito."""
+        completar_duraciones()
+        placas = reconstruir_resumen_transito()
+        db.session.commit()
+
+        print(f"✅ Resumen de tránsito reconstruido ({placas} placas).")
+
     @app.route("/sw.js")
     def sw():
         return send_from_directory("static", "sw.js")
@@ -119,8 +154,34 @@ def create_app():
         return render_template("500.html"), 500
 
     with app.app_context():
+        # Esquema aparte: si falla (o lo aplica otro worker) el resto del
+        # arranque sigue igual; se reintenta en el próximo arranque o con
+        # `flask asegurar-esquema`
         try:
-            db.create_all()
+            if not asegurar_esquema():
+                app.logger.info("Otro proceso está aplicando el esquema")
+
+        except Exception as e:
+            app.logger.error(f"Error aplicando cambios de esquema: {e}")
+
+        try:
+            # Viajes en ruta anteriores a vence_en: se les calcula una vez
+            umbrales = tiempos_cache.obtener()
+            recalcular_vencimientos(
+                umbrales.min_import,
+                umbrales.min_export,
+                solo_faltantes=True,
+            )
+            db.session.commit()
+
+            # Viajes finalizados anteriores a duracion_segundos
+            completar_duraciones()
+            db.session.commit()
+
+            # Resumen del reporte de choferes: se llena desde el historial la
+            # primera vez; después lo mantiene cada cierre de movimiento
+            llenar_resumen_si_vacio()
+            db.session.commit()
 
             admin_existente = Usuario.query.filter_by(
                 email="italamo@alamoterminales.com"
@@ -144,154 +205,183 @@ def create_app():
             db.session.rollback()
             app.logger.error(f"Error creando tablas o usuario admin: {e}")
 
+    # Los comandos `flask ...` (p. ej. reconstruir-resumen-transito) cargan
+    # la app dentro de un contexto de click: ahí no se arrancan los hilos,
+    # salvo en `flask run`, que sí sirve la app
+    contexto = click.get_current_context(silent=True)
+    en_cli = contexto is not None and contexto.info_name != "run"
+
+    if app.config.get("ALERTAS_PROGRAMADOR") and not en_cli:
+        iniciar_evaluador(app)
+        iniciar_despachador(app)
+
     return app
 
 
-def verificar_movimientos_periodicamente(app):
+_evaluador_iniciado = False
+
+
+def iniciar_evaluador(app):
     """
-    Revisa cada minuto los movimientos en ruta.
+    Arranca el hilo evaluador en este proceso (una vez).
 
-    - Importación usa min_import.
-    - Exportación usa min_export.
-    - Luego de la primera alerta, reenvía cada 4 minutos.
-    - Si el movimiento se cierra, deja de notificar.
+    Bajo gunicorn cada worker lo arranca desde create_app(), pero solo el
+    que tiene el lock de líder en Postgres evalúa; los demás esperan para
+    tomar el relevo si el líder se cae.
+    """
+    global _evaluador_iniciado
+
+    if _evaluador_iniciado:
+        return
+
+    _evaluador_iniciado = True
+
+    verificador = threading.Thread(
+        target=verificar_movimientos_periodicamente,
+        args=(app,),
+        name="evaluador-alertas",
+        daemon=True,
+    )
+
+    verificador.start()
+
+
+_despachador_iniciado = False
+
+# Sin commits locales, el despachador revisa el outbox cada 5 segundos
+# (notificaciones encoladas por otros procesos o reintentos con backoff).
+ESPERA_DESPACHO_SEGUNDOS = 5
+LOTE_DESPACHO = 50
+
+
+def iniciar_despachador(app):
+    """Arranca el hilo que entrega el outbox de notificaciones (una vez)."""
+    global _despachador_iniciado
+
+    if _despachador_iniciado:
+        return
+
+    _despachador_iniciado = True
+
+    despachador = threading.Thread(
+        target=despachar_outbox_periodicamente,
+        args=(app,),
+        name="despachador-outbox",
+        daemon=True,
+    )
+
+    despachador.start()
+
+
+def despachar_outbox_periodicamente(app):
     """
+    Entrega las notificaciones del outbox en lotes.
 
-    ultima_alerta = {}
+    Despierta apenas un commit local encola algo; si no, revisa cada pocos
+    segundos. Varios workers pueden drenar a la vez (SKIP LOCKED).
+    """
 
     while True:
+        procesadas = 0
+
         try:
             with app.app_context():
-                ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+                procesadas = drenar_outbox(LOTE_DESPACHO)
+                db.session.remove()
 
-                print(
-                    "⏱️ Verificando movimientos activos...",
-                    ahora.strftime("%H:%M:%S %d/%m/%Y"),
-                )
+        except Exception as e:
+            try:
+                db.session.rollback()
+            except Exception:
+                pass
 
-                cfg = (
-                    ConfigTiempos.query
-                    .order_by(ConfigTiempos.id.desc())
-                    .first()
-                )
+            try:
+                db.session.remove()
+            except Exception:
+                pass
 
-                min_import = cfg.min_import if cfg else 20
-                min_export = cfg.min_export if cfg else 30
+            app.logger.error(
+                f"Error despachando outbox: {e}"
+            )
 
-                movimientos = (
-                    MovimientoBarco.query
-                    .filter_by(estado="en_ruta")
-                    .all()
-                )
+        # Lote lleno: puede haber más pendientes, seguimos sin esperar
+        if procesadas >= LOTE_DESPACHO:
+            continue
 
-                if not movimientos:
-                    ultima_alerta.clear()
-                    db.session.remove()
-                    time.sleep(60)
-                    continue
-
-                operacion_ids = {
-                    mov.operacion_id
-                    for mov in movimientos
-                    if mov.operacion_id
-                }
-
-                operaciones = (
-                    Operacion.query
-                    .filter(Operacion.id.in_(operacion_ids))
-                    .all()
-                    if operacion_ids
-                    else []
-                )
+        despertado = despertar_despacho.wait(ESPERA_DESPACHO_SEGUNDOS)
+        despertar_despacho.clear()
+
+        # Sin actividad: lo que los envíos dejaron anotado en memoria se
+        # escribe igual, no espera a la próxima notificación
+        if not despertado:
+            guardar_estado_push(app)
+
+
+def guardar_estado_push(app):
+    """Escribe last_seen, fallos y endpoints muertos anotados por los envíos."""
+    try:
+        with app.app_context():
+            guardar_estado_suscripciones(forzar=True)
+            db.session.commit()
+            db.session.remove()
+
+    except Exception as e:
+        try:
+            db.session.rollback()
+        except Exception:
+            pass
 
-                operaciones_map = {
-                    op.id: op
-                    for op in operaciones
-                }
-
-                for mov in movimientos:
-                    if not mov.hora_salida:
-                        continue
-
-                    minutos = (
-                        ahora - mov.hora_salida
-                    ).total_seconds() / 60
-
-                    oper = operaciones_map.get(mov.operacion_id)
-
-                    tipo = (
-                        getattr(oper, "tipo_operacion", "") or ""
-                    ).strip().lower()
-
-                    if tipo == "importacion":
-                        umbral = min_import
-                        tipo_label = "IMPORTACIÓN"
-                    else:
-                        umbral = min_export
-                        tipo_label = "EXPORTACIÓN"
-
-                    if minutos < umbral:
-                        continue
-
-                    ultimo_envio = ultima_alerta.get(mov.id)
-
-                    if (
-                        not ultimo_envio
-                        or (ahora - ultimo_envio).total_seconds() >= 240
-                    ):
-                        mensaje = (
-                            "🚨 *ALERTA DE RETRASO EN RUTA!*\n"
-                            f"📌 Tipo: {tipo_label}\n"
-                            f"🎯 Umbral: {umbral} min\n"
-                            f"🧱 Contenedor: {mov.contenedor}\n"
-                            f"🚛 Placa: {mov.placa.numero_placa}\n"
-                            f"👨‍🔧 Chofer: {mov.placa.propietario or 'Desconocido'}\n"
-                            f"🕒 Inicio: {mov.hora_salida.strftime('%H:%M %d/%m/%Y')}\n"
-                            f"⏱️ Tiempo transcurrido: {int(minutos)} minutos"
-                        )
-
-                        try:
-                            alerta_id = guardar_ultima_alerta(
-                                f"🚨 Retraso: {tipo_label}",
-                                mensaje,
-                                tipo="emergencia",
-                                operacion_id=mov.operacion_id,
-                                movimiento_id=mov.id,
-                            )
-
-                            url_alerta = (
-                                f"/notificaciones/alerta/{alerta_id}"
-                                if alerta_id
-                                else "/notificaciones/alerta"
-                            )
-
-                            enviar_push_mismo_mensaje(
-                                mensaje,
-                                f"🚨 Retraso: {tipo_label}",
-                                url=url_alerta
-                            )
-
-                            ultima_alerta[mov.id] = ahora
-
-                        except Exception as e:
-                            try:
-                                db.session.rollback()
-                            except Exception:
-                                pass
-
-                            app.logger.error(
-                                f"Error enviando push del movimiento "
-                                f"{mov.id}: {e}"
-                            )
-
-                ids_activos = {
-                    mov.id
-                    for mov in movimientos
-                }
-
-                for mid in list(ultima_alerta.keys()):
-                    if mid not in ids_activos:
-                        ultima_alerta.pop(mid, None)
+        try:
+            db.session.remove()
+        except Exception:
+            pass
+
+        app.logger.error(
+            f"Error guardando estado de suscripciones push: {e}"
+        )
+
+
+def verificar_movimientos_periodicamente(app):
+    """
+    Evaluador de alertas de retraso.
+
+    - Solo corre en el proceso líder (advisory lock en Postgres).
+    - Duerme hasta el próximo vencimiento del registro de viajes en ruta,
+      o hasta que el registro cambie (movimiento nuevo, cierre, tiempos).
+    - Solo lee de BD los viajes que vencieron.
+    - Importación usa min_import, exportación usa min_export.
+    - Luego de la primera alerta, reenvía cada 4 minutos.
+    """
+
+    lider = LiderAlertas()
+
+    while True:
+        espera = RECARGA_REGISTRO_SEGUNDOS
+
+        try:
+            with app.app_context():
+                ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+
+                if lider.es_lider and not hay_viajes_por_evaluar(ahora):
+                    # Líder sin nada vencido ni recarga pendiente: el tick no
+                    # toca la BD (ni SELECT 1 del líder ni lock de evaluación),
+                    # salvo la firma de viajes en ruta cada pocos segundos
+                    espera = registro_viajes.segundos_hasta_proximo(
+                        ahora,
+                        REVISION_REGISTRO_SEGUNDOS,
+                    )
+                elif lider.mantener():
+                    with evaluacion_exclusiva() as turno:
+                        if turno:
+                            evaluar_viajes_vencidos()
+
+                    ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+                    espera = registro_viajes.segundos_hasta_proximo(
+                        ahora,
+                        REVISION_REGISTRO_SEGUNDOS,
+                    )
+                else:
+                    espera = REINTENTO_LIDER_SEGUNDOS
 
                 db.session.remove()
 
@@ -310,20 +400,12 @@ def verificar_movimientos_periodicamente(app):
                 f"Error en verificación automática: {e}"
             )
 
-        time.sleep(60)
+        registro_viajes.esperar(max(espera, 0.2))
 
 
 if __name__ == "__main__":
     app = create_app()
 
-    verificador = threading.Thread(
-        target=verificar_movimientos_periodicamente,
-        args=(app,),
-        daemon=True,
-    )
-
-    verificador.start()
-
     app.run(
         host="0.0.0.0",
         port=5000,
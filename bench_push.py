@@ -0,0 +1,105 @@
+# bench_push.py
+"""
+Micro-benchmark del cifrado de una difusión Web Push (solo CPU, sin red).
+
+Compara, para N suscripciones, el camino de pywebpush por envío (llave
+efímera nueva, lectura de la llave VAPID, firma del JWT y parseo del
+p256dh en cada envío) contra CifradorDifusion (models/push_cifrado.py).
+
+Uso: python bench_push.py [suscripciones] [repeticiones]
+"""
+import base64
+import json
+import os
+import sys
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
+from pywebpush import WebPusher
+
+from models.push_cifrado import CifradorDifusion
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _suscripcion(i: int) -> dict:
+    llave = ec.generate_private_key(ec.SECP256R1())
+    publica = llave.public_key().public_bytes(
+        serialization.Encoding.X962,
+        serialization.PublicFormat.UncompressedPoint,
+    )
+
+    return {
+        "endpoint": f"https://fcm.googleapis.com/fcm/send/bench-{i}",
+        "keys": {
+            "p256dh": _b64(publica),
+            "auth": _b64(os.urandom(16)),
+        },
+    }
+
+
+def _llave_vapid() -> str:
+    vapid = Vapid()
+    vapid.generate_keys()
+    privada = vapid.private_key.private_numbers().private_value
+    return _b64(privada.to_bytes(32, "big"))
+
+
+def por_envio(subs, payload, vapid_private, vapid_subject):
+    for sub in subs:
+        Vapid.from_string(private_key=vapid_private).sign({
+            "sub": vapid_subject,
+            "aud": "https://fcm.googleapis.com",
+            "exp": int(time.time()) + 12 * 60 * 60,
+        })
+        WebPusher(sub).encode(payload)
+
+
+def difusion(subs, payload, vapid_private, vapid_subject):
+    cifrador = CifradorDifusion(payload, vapid_private, vapid_subject)
+
+    for sub in subs:
+        cifrador.cifrar(sub["keys"]["p256dh"], sub["keys"]["auth"])
+        cifrador.encabezados("https://fcm.googleapis.com")
+
+
+def _medir(funcion, repeticiones, *args) -> float:
+    inicio = time.perf_counter()
+
+    for _ in range(repeticiones):
+        funcion(*args)
+
+    return (time.perf_counter() - inicio) * 1000 / repeticiones
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    subs = [_suscripcion(i) for i in range(n)]
+    payload = json.dumps({
+        "title": "🚨 Emergencia: EXPORTACIÓN",
+        "body": "ALERTA DE EMERGENCIA Un vehículo lleva más de 30 minutos sin cerrarse.",
+        "url": "/notificaciones/alerta/123",
+    }).encode("utf-8")
+    vapid_private = _llave_vapid()
+    vapid_subject = "mailto:ti@alamo.com"
+
+    # Calienta caches (JWT y llaves parseadas): mide el estado estable
+    difusion(subs, payload, vapid_private, vapid_subject)
+
+    antes = _medir(por_envio, repeticiones, subs, payload, vapid_private, vapid_subject)
+    despues = _medir(difusion, repeticiones, subs, payload, vapid_private, vapid_subject)
+
+    print(f"Suscripciones: {n} | repeticiones: {repeticiones}")
+    print(f"pywebpush por envío : {antes:8.2f} ms CPU por difusión")
+    print(f"CifradorDifusion    : {despues:8.2f} ms CPU por difusión")
+    print(f"Ahorro              : {antes - despues:8.2f} ms ({(1 - despues / antes) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
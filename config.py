@@ -83,6 +83,26 @@ class Config:
     WHATSAPP_PHONE_5 = os.getenv("WHATSAPP_PHONE_5")
     CALLMEBOT_API_KEY_5 = os.getenv("CALLMEBOT_API_KEY_5")
 
+    # URL del servicio (se puede apuntar a un stand-in local para pruebas)
+    CALLMEBOT_URL = os.getenv("CALLMEBOT_URL", "https://api.callmebot.com/whatsapp.php")
+
+    # Timeout por request y plazo total de un envío a todos los números
+    WHATSAPP_TIMEOUT_SEGUNDOS = float(os.getenv("WHATSAPP_TIMEOUT_SEGUNDOS", "10"))
+    WHATSAPP_PLAZO_SEGUNDOS = float(os.getenv("WHATSAPP_PLAZO_SEGUNDOS", "15"))
+
+    # Separación mínima entre mensajes al mismo número (límite de CallMeBot)
+    WHATSAPP_INTERVALO_SEGUNDOS = float(os.getenv("WHATSAPP_INTERVALO_SEGUNDOS", "3"))
+
+    # ============================================================
+    # ⏱️ EVALUADOR DE ALERTAS EMBEBIDO
+    # ============================================================
+    # Cada worker de gunicorn arranca el hilo; solo el líder evalúa.
+
+    ALERTAS_PROGRAMADOR = os.getenv("ALERTAS_PROGRAMADOR", "true").lower() == "true"
+
+    # Varios viajes vencidos en el mismo tick => un solo push resumen
+    ALERTAS_DIGEST = os.getenv("ALERTAS_DIGEST", "true").lower() == "true"
+
     # ============================================================
     # 🐞 DEBUG
     # ============================================================
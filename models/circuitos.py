@@ -0,0 +1,140 @@
+# models/circuitos.py
+import threading
+import time
+from collections import deque
+
+# ============================================================
+# 🔌 CIRCUIT BREAKERS POR CANAL / ORIGEN
+# ============================================================
+# Si un servicio externo (CallMeBot, FCM, Mozilla...) está caído o lento,
+# cada envío esperaría su timeout completo. El circuito mira los últimos
+# resultados y, si la tasa de fallos es alta, se abre: los envíos a ese
+# destino se saltan de inmediato y el mensaje se reencola para después.
+#
+#   cerrado  -> normal; se abre si fallan >= 50% de los últimos 20
+#               (con al menos 5 resultados)
+#   abierto  -> no se envía nada durante 30s
+#   semiabierto -> se deja pasar una prueba; si sale bien se cierra,
+#               si falla vuelve a abrirse
+
+VENTANA_RESULTADOS = 20
+MINIMO_RESULTADOS = 5
+TASA_FALLOS_APERTURA = 0.5
+SEGUNDOS_ABIERTO = 30
+
+CERRADO = "cerrado"
+ABIERTO = "abierto"
+SEMIABIERTO = "semiabierto"
+
+
+class CircuitoAbierto(Exception):
+    """El destino tiene el circuito abierto: reintentar en `segundos`."""
+
+    def __init__(self, nombre: str, segundos: float):
+        super().__init__(f"Circuito abierto: {nombre}")
+        self.nombre = nombre
+        self.segundos = segundos
+
+
+class Circuito:
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        self.estado = CERRADO
+        self._lock = threading.Lock()
+        self._resultados = deque(maxlen=VENTANA_RESULTADOS)
+        self._abierto_en = None
+        self._prueba_en_curso = False
+        self.aperturas = 0
+
+    def segundos_para_reintentar(self) -> float:
+        with self._lock:
+            if self.estado != ABIERTO:
+                return 0
+
+            return max(0.0, self._abierto_en + SEGUNDOS_ABIERTO - time.monotonic())
+
+    def permitir(self) -> bool:
+        """True si se puede enviar ahora (en semiabierto, solo una prueba)."""
+        with self._lock:
+            if self.estado == CERRADO:
+                return True
+
+            if self.estado == ABIERTO:
+                if time.monotonic() - self._abierto_en < SEGUNDOS_ABIERTO:
+                    return False
+
+                self.estado = SEMIABIERTO
+                self._prueba_en_curso = False
+
+            if self._prueba_en_curso:
+                return False
+
+            self._prueba_en_curso = True
+            return True
+
+    def registrar(self, exito: bool):
+        with self._lock:
+            if self.estado == SEMIABIERTO:
+                if exito:
+                    self.estado = CERRADO
+                    self._resultados.clear()
+                else:
+                    self._abrir()
+
+                self._prueba_en_curso = False
+                return
+
+            if self.estado != CERRADO:
+                return
+
+            self._resultados.append(exito)
+
+            if len(self._resultados) < MINIMO_RESULTADOS:
+                return
+
+            fallos = self._resultados.count(False)
+
+            if fallos / len(self._resultados) >= TASA_FALLOS_APERTURA:
+                self._abrir()
+
+    def _abrir(self):
+        self.estado = ABIERTO
+        self._abierto_en = time.monotonic()
+        self._resultados.clear()
+        self.aperturas += 1
+
+    def a_dict(self) -> dict:
+        reintentar = self.segundos_para_reintentar()
+
+        with self._lock:
+            return {
+                "nombre": self.nombre,
+                "estado": self.estado,
+                "resultados": len(self._resultados),
+                "fallos": self._resultados.count(False),
+                "aperturas": self.aperturas,
+                "reabre_en_segundos": round(reintentar, 1),
+            }
+
+
+_lock = threading.Lock()
+_circuitos = {}
+
+
+def circuito(nombre: str) -> Circuito:
+    """Circuito de este proceso para el canal u origen dado."""
+    with _lock:
+        c = _circuitos.get(nombre)
+
+        if c is None:
+            c = Circuito(nombre)
+            _circuitos[nombre] = c
+
+        return c
+
+
+def estado_circuitos() -> list:
+    with _lock:
+        circuitos = list(_circuitos.values())
+
+    return [c.a_dict() for c in sorted(circuitos, key=lambda c: c.nombre)]
@@ -0,0 +1,182 @@
+# models/esquema.py
+import re
+
+from sqlalchemy import text
+
+from models.base import db
+from models.programador import LLAVE_ESQUEMA
+
+# ============================================================
+# 🛠️ CAMBIOS DE ESQUEMA SOBRE TABLAS EXISTENTES
+# ============================================================
+# db.create_all() solo crea tablas que no existen. Los índices y
+# columnas que se agregan después a una tabla ya creada en producción
+# se aplican aquí, siempre de forma idempotente.
+#  - Un solo proceso a la vez (advisory lock): los workers que arrancan
+#    juntos no chocan creando lo mismo.
+#  - Los índices se crean CONCURRENTLY: no bloquean las escrituras de la
+#    tabla mientras se construyen (por eso corre en autocommit).
+#  - lock_timeout: un ALTER que queda detrás de consultas largas falla y
+#    se reintenta en el próximo arranque, en vez de frenar las escrituras.
+
+ESPERA_LOCK_ESQUEMA = "5s"
+
+_CREAR_INDICE = re.compile(r"CREATE INDEX IF NOT EXISTS (\w+)")
+
+_INDICE_INVALIDO = """
+    SELECT 1
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'operacionbarco'
+      AND c.relname = :nombre
+      AND NOT i.indisvalid
+"""
+
+SENTENCIAS_POSTGRES = [
+    """
+    CREATE INDEX IF NOT EXISTS ix_movimientos_barco_operacion_estado_salida
+    ON operacionbarco.movimientos_barco (operacion_id, estado, hora_salida)
+    """,
+    """
+    ALTER TABLE operacionbarco.config_tiempos
+    ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1
+    """,
+    """
+    ALTER TABLE operacionbarco.movimientos_barco
+    ADD COLUMN IF NOT EXISTS vence_en TIMESTAMP
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_movimientos_barco_vence_en_en_ruta
+    ON operacionbarco.movimientos_barco (vence_en)
+    WHERE estado = 'en_ruta'
+    """,
+    """
+    ALTER TABLE operacionbarco.push_subscriptions
+    ADD COLUMN IF NOT EXISTS fallos_consecutivos INTEGER NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE operacionbarco.push_subscriptions
+    ADD COLUMN IF NOT EXISTS suspendida_hasta TIMESTAMP
+    """,
+    """
+    ALTER TABLE operacionbarco.notificaciones_outbox
+    ADD COLUMN IF NOT EXISTS origen VARCHAR(200)
+    """,
+    """
+    ALTER TABLE operacionbarco.notificaciones_outbox
+    ADD COLUMN IF NOT EXISTS origenes_aparte TEXT
+    """,
+    # fecha es la clave del historial paginado (keyset): sin NULLs. Las
+    # filas viejas sin fecha toman la del primer aviso o, si tampoco hay,
+    # quedan al final del historial
+    """
+    UPDATE operacionbarco.notificaciones_alerta
+    SET fecha = COALESCE(primera_fecha, TIMESTAMP '1970-01-01')
+    WHERE fecha IS NULL
+    """,
+    """
+    ALTER TABLE operacionbarco.notificaciones_alerta
+    ALTER COLUMN fecha SET NOT NULL
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_notificaciones_alerta_fecha_id
+    ON operacionbarco.notificaciones_alerta (fecha, id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_notificaciones_alerta_tipo_fecha_id
+    ON operacionbarco.notificaciones_alerta (tipo, fecha, id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_notificaciones_alerta_operacion_fecha_id
+    ON operacionbarco.notificaciones_alerta (operacion_id, fecha, id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_notificaciones_alerta_movimiento_fecha_id
+    ON operacionbarco.notificaciones_alerta (movimiento_id, fecha, id)
+    """,
+    """
+    ALTER TABLE operacionbarco.notificaciones_alerta
+    ADD COLUMN IF NOT EXISTS primera_fecha TIMESTAMP
+    """,
+    """
+    ALTER TABLE operacionbarco.notificaciones_alerta
+    ADD COLUMN IF NOT EXISTS conteo INTEGER NOT NULL DEFAULT 1
+    """,
+    """
+    ALTER TABLE operacionbarco.notificaciones_alerta
+    ADD COLUMN IF NOT EXISTS minutos_transcurridos INTEGER
+    """,
+    """
+    ALTER TABLE operacionbarco.movimientos_barco
+    ADD COLUMN IF NOT EXISTS duracion_segundos INTEGER
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_movimientos_barco_duracion_llegada
+    ON operacionbarco.movimientos_barco (duracion_segundos, hora_llegada DESC)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_movimientos_barco_estado_llegada
+    ON operacionbarco.movimientos_barco (estado, hora_llegada)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_movimientos_barco_operacion_llegada
+    ON operacionbarco.movimientos_barco (operacion_id, hora_llegada)
+    """,
+]
+
+
+def _aplicar(conexion, sentencia):
+    indice = _CREAR_INDICE.search(sentencia)
+
+    if not indice:
+        conexion.execute(text(sentencia))
+        return
+
+    nombre = indice.group(1)
+
+    # Un CONCURRENTLY interrumpido deja el índice inválido, e IF NOT EXISTS
+    # lo daría por hecho: se borra y se vuelve a crear
+    if conexion.execute(text(_INDICE_INVALIDO), {"nombre": nombre}).first():
+        conexion.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS operacionbarco.{nombre}"))
+
+    conexion.execute(text(sentencia.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)))
+
+
+def asegurar_esquema() -> bool:
+    """
+    Crea las tablas nuevas y aplica los cambios pendientes.
+
+    En Postgres usa una conexión propia en autocommit y el lock de esquema
+    sin esperar: si otro proceso ya lo está aplicando retorna False y quien
+    llama sigue arrancando.
+    """
+    if db.engine.dialect.name != "postgresql":
+        db.create_all()
+        return True
+
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conexion:
+        obtenido = conexion.execute(
+            text("SELECT pg_try_advisory_lock(:llave)"),
+            {"llave": LLAVE_ESQUEMA},
+        ).scalar()
+
+        if not obtenido:
+            return False
+
+        try:
+            conexion.execute(text(f"SET lock_timeout = '{ESPERA_LOCK_ESQUEMA}'"))
+
+            db.metadata.create_all(bind=conexion)
+
+            for sentencia in SENTENCIAS_POSTGRES:
+                _aplicar(conexion, sentencia)
+
+        finally:
+            conexion.execute(text("RESET lock_timeout"))
+            conexion.execute(
+                text("SELECT pg_advisory_unlock(:llave)"),
+                {"llave": LLAVE_ESQUEMA},
+            )
+
+    return True
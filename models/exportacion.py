@@ -0,0 +1,127 @@
+# models/exportacion.py
+import csv
+import io
+import tempfile
+from datetime import datetime
+
+from flask import Response, current_app, send_file, stream_with_context
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment
+from openpyxl.utils import get_column_letter
+
+from models.base import db
+
+# ============================================================
+# 📤 EXPORTACIONES EN STREAMING (CSV / XLSX)
+# ============================================================
+# Las filas llegan de la BD por tandas (yield_per) y se escriben al vuelo,
+# sin cargar todo el resultado: la memoria no crece con las filas.
+#  - CSV: cada tanda sale al navegador apenas se escribe.
+#  - XLSX: openpyxl en modo write-only con anchos fijos (sin segunda
+#    pasada). El zip no se puede emitir a medias: el libro se arma completo
+#    en un archivo temporal (pasa a disco si crece) antes del primer byte
+#    y luego se envía por partes.
+
+FILAS_POR_TANDA = 500
+MAX_XLSX_EN_MEMORIA = 1024 * 1024
+
+FORMATOS = ("xlsx", "csv")
+
+MIMETYPE_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _valor_csv(valor):
+    if valor is None:
+        return ""
+
+    if isinstance(valor, datetime):
+        return valor.strftime("%Y-%m-%d %H:%M:%S")
+
+    return valor
+
+
+def respuesta_csv(nombre, encabezados, filas):
+    """CSV (UTF-8 con BOM, para que Excel respete tildes) enviado por tandas."""
+
+    def generar():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+
+        buffer.write("\ufeff")
+        escritor.writerow(encabezados)
+
+        # El encabezado sale de inmediato
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+        try:
+            for i, fila in enumerate(filas, 1):
+                escritor.writerow([_valor_csv(v) for v in fila])
+
+                if i % FILAS_POR_TANDA == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+
+            yield buffer.getvalue()
+
+        except Exception as e:
+            # La respuesta ya empezó: solo queda cortarla y dejar registro
+            db.session.rollback()
+            current_app.logger.exception(f"Error exportando {nombre}.csv: {e}")
+
+    return Response(
+        stream_with_context(generar()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{nombre}.csv"'},
+    )
+
+
+def respuesta_xlsx(nombre, hoja, encabezados, anchos, filas):
+    """XLSX en modo write-only: filas y libro en archivos temporales."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(hoja)
+
+    for col, ancho in enumerate(anchos, 1):
+        ws.column_dimensions[get_column_letter(col)].width = ancho
+
+    fila_encabezados = []
+
+    for titulo in encabezados:
+        celda = WriteOnlyCell(ws, value=titulo)
+        celda.font = Font(bold=True)
+        celda.alignment = Alignment(horizontal="center", vertical="center")
+        fila_encabezados.append(celda)
+
+    ws.append(fila_encabezados)
+
+    for fila in filas:
+        ws.append(list(fila))
+
+    archivo = tempfile.SpooledTemporaryFile(max_size=MAX_XLSX_EN_MEMORIA)
+    wb.save(archivo)
+    archivo.seek(0)
+
+    return send_file(
+        archivo,
+        as_attachment=True,
+        download_name=f"{nombre}.xlsx",
+        mimetype=MIMETYPE_XLSX,
+    )
+
+
+def responder_exportacion(formato, nombre, hoja, encabezados, anchos, filas):
+    """
+    Respuesta de descarga en el formato pedido ("xlsx" por defecto).
+
+    `nombre` va sin extensión (se le agrega la fecha); `filas` es un
+    iterable de tuplas en el orden de `encabezados`.
+    """
+    nombre = f"{nombre}_{datetime.now().strftime('%Y-%m-%d_%H%M')}"
+
+    if formato == "csv":
+        return respuesta_csv(nombre, encabezados, filas)
+
+    return respuesta_xlsx(nombre, hoja, encabezados, anchos, filas)
@@ -3,23 +3,45 @@ from datetime import datetime
 import pytz
 from models.base import db
 
-# ✅ NUEVO (necesario para push + guardar alerta)
-import os
-import json
+# ✅ NUEVO (necesario para guardar alerta)
 from flask import current_app
-from pywebpush import webpush, WebPushException
-from models.push_subscription import PushSubscription
+from models.notificacion_outbox import encolar_notificacion
+from models.notificacion_alerta import NotificacionAlerta, anotar_ultima_alerta
 from flask import has_app_context
 
 # ✅ NUEVO: para determinar umbral por import/export al cerrar
-from models.tiempo import ConfigTiempos
+from models.tiempo import tiempos_cache
 from models.operacion import Operacion
+from models.registro_viajes import (
+    calcular_vencimiento,
+    INTERVALO_RENOTIFICAR,
+)
 
 CR_TZ = pytz.timezone("America/Costa_Rica")
 
 class MovimientoBarco(db.Model):
     __tablename__ = "movimientos_barco"
-    __table_args__ = {"schema": "operacionbarco"}
+    __table_args__ = (
+        # Viajes en ruta de una operación ordenados por salida
+        # (detección de orden incorrecto al cerrar un movimiento)
+        db.Index(
+            "ix_movimientos_barco_operacion_estado_salida",
+            "operacion_id",
+            "estado",
+            "hora_salida",
+        ),
+        # Reportes filtrados por rango de llegada (todas las operaciones
+        # o una operación)
+        db.Index("ix_movimientos_barco_estado_llegada", "estado", "hora_llegada"),
+        db.Index("ix_movimientos_barco_operacion_llegada", "operacion_id", "hora_llegada"),
+        # Evaluador de alertas: rango sobre vence_en solo de viajes en ruta
+        db.Index(
+            "ix_movimientos_barco_vence_en_en_ruta",
+            "vence_en",
+            postgresql_where=db.text("estado = 'en_ruta'"),
+        ),
+        {"schema": "operacionbarco"},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -42,10 +64,18 @@ class MovimientoBarco(db.Model):
     )
     hora_llegada = db.Column(db.DateTime, nullable=True)
 
+    # Duración del viaje (se fija al finalizar): la usan los reportes sin
+    # calcular hora_llegada - hora_salida fila por fila
+    duracion_segundos = db.Column(db.Integer, nullable=True)
+
     estado = db.Column(db.String(20), default="en_ruta")
 
     ultima_notificacion = db.Column(db.DateTime, nullable=True)
 
+    # Próxima alerta (umbral o re-notificación): la fija quien crea el
+    # movimiento, el evaluador al notificar y guardar_tiempos al cambiar umbrales
+    vence_en = db.Column(db.DateTime, nullable=True)
+
     alerta_orden_enviada = db.Column(db.Boolean, default=False)
 
     cerrado_por_user_id = db.Column(
@@ -95,173 +125,156 @@ class MovimientoBarco(db.Model):
     def marcar_notificado(self):
         self.ultima_notificacion = self._ahora()
 
-    # ======================================================
-    # ✅ NUEVO: Helpers mínimos para Push (solo para ALERTA RESUELTA)
-    # ======================================================
-
-    def _push_text(self, texto: str, max_len: int = 180) -> str:
-        # Push suele fallar si el payload es muy largo → mandamos resumen
-        t = (texto or "").replace("*", "")
-        t = " ".join(t.split())
-        return (t[:max_len - 1] + "…") if len(t) > max_len else t
-
-    def _guardar_ultima_alerta(self, titulo: str, mensaje: str):
-        # Guarda lo completo para ver “en grande” en /notificaciones/alerta
-        try:
-            ruta = os.path.join(current_app.root_path, "last_alert.json")
-            data = {
-                "titulo": titulo,
-                "mensaje": mensaje,
-                "fecha": datetime.now(CR_TZ).strftime("%d/%m/%Y %H:%M:%S")
-            }
-            with open(ruta, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception:
-            # Cero riesgo: si esto falla, no afecta WhatsApp ni el cierre
-            pass
-
-    def _enviar_push(self, titulo: str, mensaje: str, url: str = "/notificaciones/alerta"):
+    @classmethod
+    def reclamar_notificaciones(cls, ids, ahora) -> set:
         """
-        Envía push a dispositivos suscritos (PostgreSQL).
-        Si un endpoint está muerto, se elimina.
+        Compare-and-set en lote sobre vence_en.
+
+        Un solo UPDATE ... RETURNING reclama el intervalo de todos los viajes
+        que siguen en ruta y vencidos. Si otro worker o instancia ya notificó
+        uno (o cambiaron los umbrales), su vence_en ya no es <= ahora y no
+        vuelve. Los reclamados quedan con la próxima alerta en 4 minutos.
+        El commit lo hace quien llama.
         """
-        try:
-            if not has_app_context():
-                return  # si se ejecuta fuera de contexto Flask, no intentamos
-
-            vapid_private = os.getenv("VAPID_PRIVATE_KEY", "")
-            vapid_subject = os.getenv("VAPID_SUBJECT", "mailto:ti@alamo.com")
-
-            if not vapid_private:
-                return
-
-            subs = PushSubscription.query.all()
-            if not subs:
-                return
-
-            payload = json.dumps({
-                "title": titulo,
-                "body": self._push_text(mensaje),
-                "url": url
-            })
-
-            for s in subs:
-                sub_info = {
-                    "endpoint": s.endpoint,
-                    "keys": {"p256dh": s.p256dh, "auth": s.auth}
-                }
-
-                try:
-                    webpush(
-                        subscription_info=sub_info,
-                        data=payload,
-                        vapid_private_key=vapid_private,
-                        vapid_claims={"sub": vapid_subject}
-                    )
-                    s.last_seen = datetime.utcnow()
-
-                except WebPushException:
-                    # endpoint muerto => se borra
-                    try:
-                        db.session.delete(s)
-                    except Exception:
-                        pass
-
-            db.session.commit()
-
-        except Exception:
-            try:
-                db.session.rollback()
-            except Exception:
-                pass
-            # No tumbamos el cierre del viaje por un push fallido
-            if has_app_context():
-                current_app.logger.exception("Error enviando push (alerta resuelta)")
+        if not ids:
+            return set()
+
+        resultado = db.session.execute(
+            db.update(cls)
+            .where(
+                cls.id.in_(ids),
+                cls.estado == "en_ruta",
+                cls.vence_en <= ahora,
+            )
+            .values(
+                ultima_notificacion=ahora,
+                vence_en=ahora + INTERVALO_RENOTIFICAR,
+            )
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        return set(resultado.scalars())
 
     # ======================================================
     # 🟩 FINALIZAR
     # ======================================================
 
-    def finalizar(self):
-        """Finaliza un movimiento y, si estaba en emergencia, envía aviso especial."""
+    def cerrar(self, hora_llegada, usuario_id) -> bool:
+        """
+        Cierre compare-and-set: en_ruta → finalizado (sin commit).
 
-        ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+        UPDATE ... WHERE estado = 'en_ruta': con dos cierres simultáneos del
+        mismo viaje (doble toque) el segundo espera el lock de la fila y ya
+        no la encuentra en ruta. Devuelve False si otro cierre ganó; quien
+        llama no debe sumar al resumen ni revisar el orden en ese caso.
 
-        # Detectar si el viaje estaba en emergencia antes de cerrar
-        estaba_en_emergencia = False
+        Si el viaje estaba en emergencia, registra además la alerta resuelta.
+        """
+        resultado = db.session.execute(
+            db.update(MovimientoBarco)
+            .where(
+                MovimientoBarco.id == self.id,
+                MovimientoBarco.estado == "en_ruta",
+            )
+            .values(
+                hora_llegada=hora_llegada,
+                estado="finalizado",
+                duracion_segundos=int((hora_llegada - self.hora_salida).total_seconds()),
+                cerrado_por_user_id=usuario_id,
+            )
+            .execution_options(synchronize_session="evaluate")
+        )
 
-        # Condición 1: más de X minutos en ruta (según import/export configurado)
-        if self.estado == "en_ruta" and self.hora_salida:
-            minutos = (ahora - self.hora_salida).total_seconds() / 60
+        if resultado.rowcount != 1:
+            return False
 
-            # ✅ AJUSTE: umbral configurable por tipo de operación
-            cfg = ConfigTiempos.query.order_by(ConfigTiempos.id.desc()).first()
-            min_import = cfg.min_import if cfg else 20
-            min_export = cfg.min_export if cfg else 30
+        self._avisar_alerta_resuelta()
 
-            oper = Operacion.query.get(self.operacion_id)
-            tipo = (getattr(oper, "tipo_operacion", "") or "").strip().lower()
+        return True
 
-            umbral = min_import if tipo == "importacion" else min_export
+    def _estaba_en_emergencia(self) -> bool:
+        """Tenía alertas enviadas o superó el umbral de su tipo de operación."""
+        if self.ultima_notificacion:
+            return True
 
-            if minutos >= umbral:
-                estaba_en_emergencia = True
+        if not self.hora_salida or not self.hora_llegada:
+            return False
 
-        # Condición 2: tenía alertas enviadas
-        if self.ultima_notificacion:
-            estaba_en_emergencia = True
-
-        # Finalizar
-        self.hora_llegada = ahora
-        self.estado = "finalizado"
-
-        # Limpiar controles
-        self.ultima_notificacion = None
-        self.alerta_orden_enviada = True
-
-        # Enviar notificación solo si estaba en emergencia
-        if estaba_en_emergencia:
-            duracion_min = int((self.hora_llegada - self.hora_salida).total_seconds() / 60)
-
-            mensaje = (
-                f"🟢 *ALERTA RESUELTA*\n"
-                f"El viaje que estaba en *EMERGENCIA* ha sido finalizado.\n\n"
-                f"📦 Identificador: {self.contenedor}\n"
-                f"🚛 Placa: {self.placa.numero_placa}\n"
-                f"🎨 Color cabezal: {self.placa.color_cabezal or 'No registrado'}\n"
-                f"👤 Chofer: {self.placa.propietario or 'No registrado'}\n"
-                f"🕒 Salida: {self.hora_salida.strftime('%d/%m/%Y %H:%M')}\n"
-                f"🏁 Llegada: {self.hora_llegada.strftime('%d/%m/%Y %H:%M')}\n"
-                f"⏱️ Duración total: {duracion_min} minutos\n\n"
-                f"✔ Emergencia cerrada correctamente."
-            )
+        minutos = (self.hora_llegada - self.hora_salida).total_seconds() / 60
 
-            try:
+        umbrales = tiempos_cache.obtener()
+        oper = db.session.get(Operacion, self.operacion_id)
+        tipo = (getattr(oper, "tipo_operacion", "") or "").strip().lower()
 
-                # ✅ Guardar alerta
-                self._guardar_ultima_alerta(
-                    "🟢 Alerta resuelta",
-                    mensaje
+        umbral = umbrales.min_import if tipo == "importacion" else umbrales.min_export
+
+        return minutos >= umbral
+
+    def _avisar_alerta_resuelta(self):
+        """
+        Alerta "resuelta" y su push (outbox) al cerrar un viaje en emergencia.
+
+        Va en un savepoint: si falla solo se descarta la alerta, el cierre
+        sigue en la transacción de quien llama.
+        """
+        try:
+            with db.session.begin_nested():
+                if not self._estaba_en_emergencia():
+                    return
+
+                duracion_min = int(
+                    (self.hora_llegada - self.hora_salida).total_seconds() / 60
+                )
+
+                mensaje = (
+                    f"🟢 *ALERTA RESUELTA*\n"
+                    f"El viaje que estaba en *EMERGENCIA* ha sido finalizado.\n\n"
+                    f"📦 Identificador: {self.contenedor}\n"
+                    f"🚛 Placa: {self.placa.numero_placa}\n"
+                    f"🎨 Color cabezal: {self.placa.color_cabezal or 'No registrado'}\n"
+                    f"👤 Chofer: {self.placa.propietario or 'No registrado'}\n"
+                    f"🕒 Salida: {self.hora_salida.strftime('%d/%m/%Y %H:%M')}\n"
+                    f"🏁 Llegada: {self.hora_llegada.strftime('%d/%m/%Y %H:%M')}\n"
+                    f"⏱️ Duración total: {duracion_min} minutos\n\n"
+                    f"✔ Emergencia cerrada correctamente."
+                )
+
+                # ✅ Guardar alerta (queda como la última en /notificaciones/alerta)
+                alerta = NotificacionAlerta(
+                    tipo="resuelta",
+                    titulo="🟢 Alerta resuelta",
+                    mensaje=mensaje,
+                    fecha=self.hora_llegada,
+                    operacion_id=self.operacion_id,
+                    movimiento_id=self.id,
                 )
+                db.session.add(alerta)
+                db.session.flush()
 
-                # ✅ Push web
-                self._enviar_push(
+                # ✅ Push web (outbox: sale después del commit del cierre)
+                encolar_notificacion(
                     "🟢 Alerta resuelta",
                     mensaje,
-                    url="/notificaciones/alerta"
+                    url=f"/notificaciones/alerta/{alerta.id}",
+                    alerta_id=alerta.id,
                 )
 
-            except Exception as e:
+            anotar_ultima_alerta(
+                alerta.id,
+                alerta.titulo,
+                alerta.mensaje,
+                alerta.fecha,
+                alerta.tipo,
+            )
+
+        except Exception as e:
 
-                try:
-                    db.session.rollback()
-                except Exception:
-                    pass
+            if has_app_context():
+                current_app.logger.exception(
+                    f"Error registrando alerta resuelta del movimiento {self.id}: {e}"
+                )
 
-                if has_app_context():
-                    current_app.logger.exception(
-                        f"Error enviando push de cierre: {e}"
-                    )
     def tiempo_total(self, formato=False):
         if self.hora_llegada:
             total_min = int((self.hora_llegada - self.hora_salida).total_seconds() / 60)
@@ -272,4 +285,135 @@ class MovimientoBarco(db.Model):
         return None
 
     def __repr__(self):
-        return f"<Movimiento {self.contenedor} - {self.estado}>"
\ No newline at end of file
+        return f"<Movimiento {self.contenedor} - {self.estado}>"
+
+
+# Reportes de viajes cortos / largos: rango sobre la duración, más
+# recientes primero
+db.Index(
+    "ix_movimientos_barco_duracion_llegada",
+    MovimientoBarco.duracion_segundos,
+    MovimientoBarco.hora_llegada.desc(),
+)
+
+# ============================================================
+# ⏱️ VENCIMIENTOS (vence_en) EN BLOQUE
+# ============================================================
+
+_RECALCULAR_POSTGRES = """
+    UPDATE operacionbarco.movimientos_barco AS m
+    SET vence_en = GREATEST(
+        m.hora_salida + interval '1 minute' * CASE
+            WHEN lower(trim(o.tipo_operacion)) = 'importacion' THEN :min_import
+            ELSE :min_export
+        END,
+        m.ultima_notificacion + interval '4 minutes'
+    )
+    FROM operacionbarco.operaciones_barco AS o
+    WHERE o.id = m.operacion_id
+      AND m.estado = 'en_ruta'
+      AND m.hora_salida IS NOT NULL
+"""
+
+
+def recalcular_vencimientos(min_import: int, min_export: int, solo_faltantes: bool = False) -> int:
+    """
+    Recalcula vence_en de todos los viajes en ruta (sin commit).
+
+    En Postgres es un solo UPDATE; en SQLite (local) se calcula aquí y se
+    actualiza en lote. Con solo_faltantes=True solo llena los que no tienen.
+    """
+    if db.engine.dialect.name == "postgresql":
+        sql = _RECALCULAR_POSTGRES
+
+        if solo_faltantes:
+            sql += " AND m.vence_en IS NULL"
+
+        return db.session.execute(
+            db.text(sql),
+            {"min_import": min_import, "min_export": min_export},
+        ).rowcount
+
+    consulta = (
+        db.session.query(
+            MovimientoBarco.id,
+            MovimientoBarco.hora_salida,
+            MovimientoBarco.ultima_notificacion,
+            Operacion.tipo_operacion,
+        )
+        .join(Operacion, Operacion.id == MovimientoBarco.operacion_id)
+        .filter(
+            MovimientoBarco.estado == "en_ruta",
+            MovimientoBarco.hora_salida.isnot(None),
+        )
+    )
+
+    if solo_faltantes:
+        consulta = consulta.filter(MovimientoBarco.vence_en.is_(None))
+
+    cambios = [
+        {
+            "id": mov_id,
+            "vence_en": calcular_vencimiento(
+                hora_salida,
+                tipo_operacion,
+                ultima_notificacion,
+                min_import,
+                min_export,
+            ),
+        }
+        for mov_id, hora_salida, ultima_notificacion, tipo_operacion in consulta
+    ]
+
+    if cambios:
+        db.session.execute(db.update(MovimientoBarco), cambios)
+
+    return len(cambios)
+
+
+# ============================================================
+# ⏱️ DURACIONES (duracion_segundos) DE VIAJES ANTERIORES
+# ============================================================
+
+_COMPLETAR_DURACIONES_POSTGRES = """
+    UPDATE operacionbarco.movimientos_barco
+    SET duracion_segundos = FLOOR(EXTRACT(EPOCH FROM (hora_llegada - hora_salida)))
+    WHERE estado = 'finalizado'
+      AND duracion_segundos IS NULL
+      AND hora_llegada IS NOT NULL
+      AND hora_salida IS NOT NULL
+"""
+
+
+def completar_duraciones() -> int:
+    """
+    Llena duracion_segundos de los viajes finalizados que no la tienen (sin commit).
+
+    Los cierres nuevos ya la guardan; esto cubre el historial anterior.
+    """
+    if db.engine.dialect.name == "postgresql":
+        return db.session.execute(db.text(_COMPLETAR_DURACIONES_POSTGRES)).rowcount
+
+    consulta = db.session.query(
+        MovimientoBarco.id,
+        MovimientoBarco.hora_salida,
+        MovimientoBarco.hora_llegada,
+    ).filter(
+        MovimientoBarco.estado == "finalizado",
+        MovimientoBarco.duracion_segundos.is_(None),
+        MovimientoBarco.hora_llegada.isnot(None),
+        MovimientoBarco.hora_salida.isnot(None),
+    )
+
+    cambios = [
+        {
+            "id": mov_id,
+            "duracion_segundos": int((hora_llegada - hora_salida).total_seconds()),
+        }
+        for mov_id, hora_salida, hora_llegada in consulta
+    ]
+
+    if cambios:
+        db.session.execute(db.update(MovimientoBarco), cambios)
+
+    return len(cambios)
@@ -1,7 +1,139 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import requests
-from urllib.parse import quote_plus
+from requests.adapters import HTTPAdapter
 from flask import current_app
 
+from models.push_envio import segundos_retry_after
+
+# ============================================================
+# 💬 ENVÍO POR WHATSAPP (CALLMEBOT)
+# ============================================================
+# Todos los números se atienden en paralelo con una sesión keep-alive
+# compartida y un plazo total: un número lento no frena a los demás ni
+# bloquea al que llama más allá del plazo.
+
+MAX_DESTINOS = 10
+
+_pool = ThreadPoolExecutor(max_workers=MAX_DESTINOS, thread_name_prefix="whatsapp")
+_lock = threading.Lock()
+_sesion = None
+
+# Formato de número que funcionó la última vez ("" o "+"), por teléfono
+_formato_telefono = {}
+
+# Cuándo se puede volver a escribir a cada teléfono (time.monotonic)
+_libre_desde = {}
+
+
+def _sesion_http() -> requests.Session:
+    global _sesion
+
+    with _lock:
+        if _sesion is None:
+            _sesion = requests.Session()
+            adaptador = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=MAX_DESTINOS,
+            )
+            _sesion.mount("https://", adaptador)
+            _sesion.mount("http://", adaptador)
+
+        return _sesion
+
+
+def _destinos():
+    """Pares (teléfono, apikey): WHATSAPP_PHONE, WHATSAPP_PHONE_1, ... hasta _9."""
+    destinos = []
+
+    for i in range(0, MAX_DESTINOS):
+        tel_key = f"WHATSAPP_PHONE{'' if i == 0 else '_' + str(i)}"
+        api_key = f"CALLMEBOT_API_KEY{'' if i == 0 else '_' + str(i)}"
+
+        tel = current_app.config.get(tel_key)
+        key = current_app.config.get(api_key)
+
+        if tel and key:
+            destinos.append((str(tel).strip(), str(key).strip()))
+
+    return destinos
+
+
+def _reservar_turno(tel: str, intervalo: float, vence: float):
+    """
+    Reserva el próximo envío a este teléfono y retorna cuánto hay que
+    esperar. Si el turno no alcanza antes de `vence` no reserva nada y
+    retorna None: el turno queda libre para el siguiente envío.
+    """
+    with _lock:
+        ahora = time.monotonic()
+        turno = max(ahora, _libre_desde.get(tel, 0))
+
+        if turno >= vence:
+            return None
+
+        _libre_desde[tel] = turno + intervalo
+
+        return turno - ahora
+
+
+def _enviar_a(tel: str, key: str, mensaje: str, ajustes: dict, vence: float):
+    """Un número: respeta su límite y prueba primero el formato que ya sirvió."""
+    espera = _reservar_turno(tel, ajustes["intervalo"], vence)
+
+    if espera is None:
+        return tel, False, "Límite de envío del número: no alcanza el plazo"
+
+    if espera > 0:
+        time.sleep(espera)
+
+    sin_mas = tel.lstrip("+")
+    formatos = ["", "+"]
+
+    if _formato_telefono.get(sin_mas) == "+":
+        formatos.reverse()
+
+    error = None
+
+    for formato in formatos:
+        restante = vence - time.monotonic()
+
+        if restante <= 0:
+            return tel, False, error or "Plazo agotado"
+
+        try:
+            r = _sesion_http().get(
+                ajustes["url"],
+                params={
+                    "phone": formato + sin_mas,
+                    "text": mensaje,
+                    "apikey": key,
+                },
+                timeout=min(ajustes["timeout"], restante),
+            )
+        except requests.RequestException as e:
+            # Timeout o red: el otro formato no lo va a arreglar
+            return tel, False, str(e)
+
+        if r.status_code == 200:
+            _formato_telefono[sin_mas] = formato
+            return tel, True, None
+
+        error = f"Código {r.status_code} - {r.text[:200]}"
+
+        if r.status_code == 429:
+            # CallMeBot pidió bajar el ritmo para este número
+            with _lock:
+                _libre_desde[tel] = time.monotonic() + max(
+                    ajustes["intervalo"],
+                    segundos_retry_after(r),
+                )
+            break
+
+    return tel, False, error
+
 
 def enviar_notificacion(mensaje: str) -> bool:
     """
@@ -11,54 +143,49 @@ def enviar_notificacion(mensaje: str) -> bool:
     """
 
     try:
-        telefonos = []
-        apikeys = []
-
-        # Cargar automáticamente WHATSAPP_PHONE, WHATSAPP_PHONE_1, ... hasta _9
-        for i in range(0, 10):
-            tel_key = f"WHATSAPP_PHONE{'' if i == 0 else '_' + str(i)}"
-            api_key = f"CALLMEBOT_API_KEY{'' if i == 0 else '_' + str(i)}"
-
-            tel = current_app.config.get(tel_key)
-            key = current_app.config.get(api_key)
-
-            if tel and key:
-                telefonos.append(str(tel).strip())
-                apikeys.append(str(key).strip())
+        destinos = _destinos()
 
-        if not telefonos:
+        if not destinos:
             current_app.logger.warning("⚠️ No hay teléfonos configurados para notificar.")
             return False
 
-        mensaje_cod = quote_plus(mensaje.strip())
-        enviado_al_menos_uno = False
-
-        for tel, key in zip(telefonos, apikeys):
+        cfg = current_app.config
+        ajustes = {
+            "url": cfg.get("CALLMEBOT_URL") or "https://api.callmebot.com/whatsapp.php",
+            "timeout": float(cfg.get("WHATSAPP_TIMEOUT_SEGUNDOS", 10)),
+            "intervalo": float(cfg.get("WHATSAPP_INTERVALO_SEGUNDOS", 3)),
+        }
+        vence = time.monotonic() + float(cfg.get("WHATSAPP_PLAZO_SEGUNDOS", 15))
+        texto = mensaje.strip()
 
-            # Intento 1 — sin “+”
-            url1 = f"https://api.callmebot.com/whatsapp.php?phone={tel}&text={mensaje_cod}&apikey={key}"
-            r1 = requests.get(url1, timeout=10)
+        futuros = {
+            _pool.submit(_enviar_a, tel, key, texto, ajustes, vence): tel
+            for tel, key in destinos
+        }
 
-            if r1.status_code == 200:
-                current_app.logger.info(f"✅ Notificación enviada a {tel} (sin +)")
-                enviado_al_menos_uno = True
-                continue
+        listos, pendientes = wait(futuros, timeout=max(0, vence - time.monotonic()))
+        enviado_al_menos_uno = False
 
-            # Intento 2 — con “+”
-            tel_plus = tel if tel.startswith("+") else "+" + tel
-            url2 = f"https://api.callmebot.com/whatsapp.php?phone={tel_plus}&text={mensaje_cod}&apikey={key}"
-            r2 = requests.get(url2, timeout=10)
+        for futuro in listos:
+            # Un número que falla no invalida lo ya entregado a los demás
+            try:
+                tel, ok, error = futuro.result()
+            except Exception as e:
+                tel, ok, error = futuros[futuro], False, f"Error inesperado: {e}"
 
-            if r2.status_code == 200:
-                current_app.logger.info(f"✅ Notificación enviada a {tel_plus} (con +)")
+            if ok:
+                current_app.logger.info(f"✅ Notificación enviada a {tel}")
                 enviado_al_menos_uno = True
             else:
-                current_app.logger.error(
-                    f"❌ Error enviando a {tel} → Código {r2.status_code} - {r2.text}"
-                )
+                current_app.logger.error(f"❌ Error enviando a {tel} → {error}")
+
+        if pendientes:
+            current_app.logger.error(
+                f"❌ {len(pendientes)} número(s) sin respuesta dentro del plazo"
+            )
 
         return enviado_al_menos_uno
 
     except Exception as e:
         current_app.logger.exception(f"❌ Error inesperado al enviar notificación: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -1,17 +1,186 @@
+import threading
+import time
 from datetime import datetime
 import pytz
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from models.base import db
 
 CR_TZ = pytz.timezone("America/Costa_Rica")
 
 class NotificacionAlerta(db.Model):
     __tablename__ = "notificaciones_alerta"
-    __table_args__ = {"schema": "operacionbarco"}
+    __table_args__ = (
+        # Historial paginado por (fecha, id), completo o filtrado
+        db.Index("ix_notificaciones_alerta_fecha_id", "fecha", "id"),
+        db.Index("ix_notificaciones_alerta_tipo_fecha_id", "tipo", "fecha", "id"),
+        db.Index("ix_notificaciones_alerta_operacion_fecha_id", "operacion_id", "fecha", "id"),
+        db.Index("ix_notificaciones_alerta_movimiento_fecha_id", "movimiento_id", "fecha", "id"),
+        {"schema": "operacionbarco"},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    tipo = db.Column(db.String(30), nullable=False, default="alerta")  # alerta / emergencia / resuelta
+    tipo = db.Column(db.String(30), nullable=False, default="alerta")  # alerta / emergencia / resuelta / prueba
     titulo = db.Column(db.String(200), nullable=False)
     mensaje = db.Column(db.Text, nullable=False)
-    fecha = db.Column(db.DateTime, default=lambda: datetime.now(CR_TZ).replace(tzinfo=None))
+    fecha = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(CR_TZ).replace(tzinfo=None),
+    )
     operacion_id = db.Column(db.Integer, nullable=True)
-    movimiento_id = db.Column(db.Integer, nullable=True)
\ No newline at end of file
+    movimiento_id = db.Column(db.Integer, nullable=True)
+
+    # Incidente: una emergencia por movimiento que se actualiza en sitio
+    # con cada re-notificación (fecha = último aviso)
+    primera_fecha = db.Column(db.DateTime, nullable=True)
+    conteo = db.Column(db.Integer, nullable=False, default=1)
+    minutos_transcurridos = db.Column(db.Integer, nullable=True)
+
+
+class EnvioAlerta(db.Model):
+    """Cada aviso de un incidente (liviano: sin el texto del mensaje)."""
+
+    __tablename__ = "notificaciones_alerta_envios"
+    __table_args__ = (
+        db.Index("ix_notificaciones_alerta_envios_alerta_fecha", "alerta_id", "fecha"),
+        {"schema": "operacionbarco"},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    alerta_id = db.Column(db.Integer, nullable=False)
+    fecha = db.Column(db.DateTime, nullable=False)
+    minutos_transcurridos = db.Column(db.Integer, nullable=True)
+
+
+# ============================================================
+# ⚡ ÚLTIMA ALERTA EN MEMORIA
+# ============================================================
+# /notificaciones/alerta muestra la alerta más reciente. Se guarda en
+# memoria: las alertas que guarda este proceso la actualizan al hacer
+# commit, y las de otros procesos se ven al vencer el TTL.
+
+ULTIMA_ALERTA_TTL_SEGUNDOS = 5
+
+
+def columnas_alerta():
+    """Columnas que usa datos_alerta(), en su orden (sin cargar la entidad)."""
+    return (
+        NotificacionAlerta.id,
+        NotificacionAlerta.titulo,
+        NotificacionAlerta.mensaje,
+        NotificacionAlerta.fecha,
+        NotificacionAlerta.tipo,
+        NotificacionAlerta.conteo,
+        NotificacionAlerta.primera_fecha,
+    )
+
+
+def datos_alerta(id, titulo, mensaje, fecha, tipo, conteo=1, primera_fecha=None) -> dict:
+    return {
+        "id": id,
+        "titulo": titulo,
+        "mensaje": mensaje,
+        "fecha": fecha.strftime("%d/%m/%Y %H:%M:%S") if fecha else "",
+        "tipo": tipo or "alerta",
+        "conteo": conteo or 1,
+        "primera_fecha": primera_fecha.strftime("%d/%m/%Y %H:%M:%S") if primera_fecha else "",
+        # Orden de "más reciente": un incidente actualizado vuelve a ser el último
+        "marca": (fecha or datetime.min, id),
+    }
+
+
+class CacheUltimaAlerta:
+    """
+    La alerta más reciente por (fecha, id) y, aparte, el id más alto.
+
+    No son la misma fila: un incidente que se re-notifica actualiza su fecha
+    y pasa a ser "la última", pero su id sigue siendo viejo. El feed por
+    since_id necesita el id más alto.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._datos = None
+        self._max_id = 0
+        self._leido_en = None
+
+    def _refrescar(self):
+        with self._lock:
+            if (
+                self._leido_en is not None
+                and time.monotonic() - self._leido_en < ULTIMA_ALERTA_TTL_SEGUNDOS
+            ):
+                return
+
+        max_id = db.select(db.func.max(NotificacionAlerta.id)).scalar_subquery()
+
+        fila = (
+            db.session.query(*columnas_alerta(), max_id)
+            .order_by(
+                NotificacionAlerta.fecha.desc(),
+                NotificacionAlerta.id.desc(),
+            )
+            .first()
+        )
+
+        datos = datos_alerta(*fila[:-1]) if fila else None
+
+        with self._lock:
+            self._datos = datos
+            self._max_id = (fila[-1] or 0) if fila else 0
+            self._leido_en = time.monotonic()
+
+    def obtener(self):
+        """Datos de la última alerta (dict) o None si no hay ninguna."""
+        self._refrescar()
+
+        with self._lock:
+            return self._datos
+
+    def ultimo_id(self) -> int:
+        """Id más alto guardado (0 si no hay alertas)."""
+        self._refrescar()
+
+        with self._lock:
+            return self._max_id
+
+    def actualizar(self, datos: dict):
+        with self._lock:
+            # Sin lectura previa no se sabe el id más alto: que lo lea obtener()
+            if self._leido_en is None:
+                return
+
+            self._max_id = max(self._max_id, datos["id"])
+
+            # Otro proceso pudo haber guardado una más nueva ya leída
+            if self._datos and self._datos["marca"] > datos["marca"]:
+                return
+
+            self._datos = datos
+            self._leido_en = time.monotonic()
+
+
+ultima_alerta = CacheUltimaAlerta()
+
+
+def anotar_ultima_alerta(id, titulo, mensaje, fecha, tipo, conteo=1, primera_fecha=None):
+    """La alerta recién guardada pasa al cache cuando se confirme el commit."""
+    datos = datos_alerta(id, titulo, mensaje, fecha, tipo, conteo, primera_fecha)
+    previa = db.session.info.get("ultima_alerta")
+
+    if previa is None or previa["marca"] < datos["marca"]:
+        db.session.info["ultima_alerta"] = datos
+
+
+@event.listens_for(Session, "after_commit")
+def _actualizar_despues_de_commit(session):
+    datos = session.info.pop("ultima_alerta", None)
+
+    if datos:
+        ultima_alerta.actualizar(datos)
+
+
+@event.listens_for(Session, "after_rollback")
+def _olvidar_despues_de_rollback(session):
+    session.info.pop("ultima_alerta", None)
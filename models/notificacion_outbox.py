@@ -0,0 +1,329 @@
+# models/notificacion_outbox.py
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.base import db
+from models.notificacion import enviar_notificacion
+from models.push_envio import difundir_push, guardar_estado_suscripciones
+from models.circuitos import circuito, CircuitoAbierto
+
+CR_TZ = pytz.timezone("America/Costa_Rica")
+
+# Reintentos con backoff exponencial: 5s, 10s, 20s... hasta 10 minutos
+MAX_INTENTOS = 8
+BACKOFF_BASE_SEGUNDOS = 5
+BACKOFF_MAX_SEGUNDOS = 600
+
+# Reserva de un lote mientras se entrega: si el proceso muere, al vencer
+# el lease las filas vuelven a estar disponibles para otro despachador
+LEASE_ENVIO_SEGUNDOS = 300
+
+
+class NotificacionOutbox(db.Model):
+    """
+    Notificación pendiente de entregar (outbox transaccional).
+
+    Se inserta en la misma transacción que el cambio de estado que la
+    origina; el despachador en segundo plano la entrega después del commit.
+    """
+
+    __tablename__ = "notificaciones_outbox"
+    __table_args__ = (
+        db.Index(
+            "ix_notificaciones_outbox_pendientes",
+            "estado",
+            "proximo_intento",
+        ),
+        {"schema": "operacionbarco"},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    canal = db.Column(db.String(20), nullable=False, default="push")  # push / whatsapp
+    titulo = db.Column(db.String(200), nullable=False)
+    mensaje = db.Column(db.Text, nullable=False)
+    url = db.Column(db.String(300), nullable=True)
+    alerta_id = db.Column(db.Integer, nullable=True)
+
+    # Solo para push reencolado por circuito abierto: el servicio de push
+    # (scheme://host) al que falta entregar. NULL = todas las suscripciones.
+    origen = db.Column(db.String(200), nullable=True)
+
+    # Orígenes que ya se reencolaron aparte desde este item (separados por
+    # espacio): en sus reintentos ya no se les envía, su copia lo entrega
+    origenes_aparte = db.Column(db.Text, nullable=True)
+
+    estado = db.Column(db.String(20), nullable=False, default="pendiente")  # pendiente / enviando / enviado / fallido
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    proximo_intento = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(CR_TZ).replace(tzinfo=None)
+    )
+    ultimo_error = db.Column(db.Text, nullable=True)
+
+    creado_en = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(CR_TZ).replace(tzinfo=None)
+    )
+    enviado_en = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<Outbox {self.id} {self.canal} - {self.estado}>"
+
+
+# ============================================================
+# 📥 ENCOLAR
+# ============================================================
+
+# Despierta al despachador de este proceso apenas se hace commit
+despertar_despacho = threading.Event()
+
+
+def encolar_notificacion(
+    titulo: str,
+    mensaje: str,
+    url: str = "/notificaciones/alerta",
+    canal: str = "push",
+    alerta_id=None,
+) -> NotificacionOutbox:
+    """Agrega la notificación a la sesión actual. El commit lo hace quien llama."""
+    item = NotificacionOutbox(
+        canal=canal,
+        titulo=titulo,
+        mensaje=mensaje,
+        url=url,
+        alerta_id=alerta_id,
+    )
+
+    db.session.add(item)
+    db.session.info["outbox_pendiente"] = True
+
+    return item
+
+
+def encolar_notificaciones(items) -> int:
+    """
+    Versión en lote de encolar_notificacion: un solo INSERT (executemany)
+    para todas. `items` son dicts con titulo, mensaje, url y alerta_id (y
+    opcionalmente canal, origen y proximo_intento).
+    """
+    ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+
+    filas = [
+        {
+            "canal": item.get("canal", "push"),
+            "titulo": item["titulo"],
+            "mensaje": item["mensaje"],
+            "url": item.get("url") or "/notificaciones/alerta",
+            "alerta_id": item.get("alerta_id"),
+            "origen": item.get("origen"),
+            "proximo_intento": item.get("proximo_intento") or ahora,
+        }
+        for item in items
+    ]
+
+    if not filas:
+        return 0
+
+    db.session.execute(db.insert(NotificacionOutbox), filas)
+    db.session.info["outbox_pendiente"] = True
+
+    return len(filas)
+
+
+@event.listens_for(Session, "after_commit")
+def _despertar_despues_de_commit(session):
+    if session.info.pop("outbox_pendiente", False):
+        despertar_despacho.set()
+
+
+@event.listens_for(Session, "after_rollback")
+def _olvidar_despues_de_rollback(session):
+    session.info.pop("outbox_pendiente", None)
+
+
+# ============================================================
+# 📤 DRENAR
+# ============================================================
+
+def _entregar(item: NotificacionOutbox) -> bool:
+    """
+    True si el canal aceptó la notificación. Lanza CircuitoAbierto si el
+    destino está caído: el item se reprograma sin gastar un intento.
+    """
+    if item.canal == "whatsapp":
+        c = circuito("whatsapp")
+
+        if not c.permitir():
+            raise CircuitoAbierto(c.nombre, c.segundos_para_reintentar())
+
+        mensaje = item.mensaje
+
+        # Sin transacción abierta durante el envío por red
+        db.session.commit()
+
+        entregado = enviar_notificacion(mensaje)
+        c.registrar(entregado)
+
+        return entregado
+
+    aparte = set((item.origenes_aparte or "").split())
+
+    resultado = difundir_push(
+        item.titulo,
+        item.mensaje,
+        url=item.url,
+        origen=item.origen,
+        excluir_origenes=aparte,
+    )
+
+    current_app.logger.info(
+        f"Push outbox {item.id}: {resultado['enviados']} ok, "
+        f"{resultado['fallidos']} fallidos, {resultado.get('errores', 0)} errores, "
+        f"latencia {resultado.get('latencia')}"
+    )
+
+    omitidos = resultado.get("omitidos", {})
+
+    if item.origen and item.origen in omitidos:
+        raise CircuitoAbierto(f"push {item.origen}", omitidos[item.origen])
+
+    # Servicios de push con el circuito abierto: se reencola un item solo
+    # para ellos, que sale cuando el circuito vuelve a probar. Una sola
+    # copia por origen aunque este item se reintente varias veces
+    nuevos = {
+        origen: segundos
+        for origen, segundos in omitidos.items()
+        if origen not in aparte
+    }
+
+    if nuevos:
+        item.origenes_aparte = " ".join(sorted(aparte | set(nuevos)))
+
+    ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+
+    encolar_notificaciones([
+        {
+            "titulo": item.titulo,
+            "mensaje": item.mensaje,
+            "url": item.url,
+            "alerta_id": item.alerta_id,
+            "origen": origen,
+            "proximo_intento": ahora + timedelta(
+                seconds=max(segundos, BACKOFF_BASE_SEGUNDOS)
+            ),
+        }
+        for origen, segundos in nuevos.items()
+    ])
+
+    # Solo se reintenta si nadie recibió y hubo errores pasajeros (red,
+    # timeout, 429, 5xx); las suscripciones muertas ya se limpiaron en el envío.
+    return not (resultado["enviados"] == 0 and resultado.get("errores", 0) > 0)
+
+
+def _reclamar_lote(limite: int, ahora: datetime) -> list:
+    """
+    Toma hasta `limite` notificaciones listas y las marca "enviando".
+
+    El bloqueo (FOR UPDATE SKIP LOCKED) dura solo esta transacción corta;
+    después el lote queda reservado por el lease: proximo_intento pasa a
+    ahora + LEASE_ENVIO_SEGUNDOS. Si el proceso muere a media entrega, al
+    vencer el lease otro despachador las vuelve a tomar.
+    """
+    lote = (
+        NotificacionOutbox.query
+        .filter(
+            NotificacionOutbox.estado.in_(("pendiente", "enviando")),
+            NotificacionOutbox.proximo_intento <= ahora,
+        )
+        .order_by(NotificacionOutbox.id.asc())
+        .limit(limite)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+    vence = ahora + timedelta(seconds=LEASE_ENVIO_SEGUNDOS)
+
+    for item in lote:
+        item.estado = "enviando"
+        item.proximo_intento = vence
+
+    db.session.commit()
+
+    return lote
+
+
+def _registrar_resultado(item: NotificacionOutbox, entregado: bool, error) -> None:
+    """Deja el item enviado, fallido o reprogramado con backoff (sin commit)."""
+    ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+
+    item.intentos = (item.intentos or 0) + 1
+
+    if entregado:
+        item.estado = "enviado"
+        item.enviado_en = ahora
+        item.ultimo_error = None
+        return
+
+    item.ultimo_error = error
+
+    if item.intentos >= MAX_INTENTOS:
+        item.estado = "fallido"
+        return
+
+    espera = min(
+        BACKOFF_MAX_SEGUNDOS,
+        BACKOFF_BASE_SEGUNDOS * (2 ** (item.intentos - 1)),
+    )
+    item.estado = "pendiente"
+    item.proximo_intento = ahora + timedelta(seconds=espera)
+
+
+def drenar_outbox(limite: int = 50) -> int:
+    """
+    Entrega un lote de notificaciones pendientes. Retorna cuántas procesó.
+
+    Primero se reclama el lote con un lease y se hace commit; los envíos
+    por red corren sin filas bloqueadas ni transacción abierta, y el
+    resultado de cada item se confirma apenas se conoce.
+    """
+    lote = _reclamar_lote(limite, datetime.now(CR_TZ).replace(tzinfo=None))
+
+    for item in lote:
+        try:
+            entregado = _entregar(item)
+            error = None if entregado else "El canal no aceptó la notificación"
+
+        except CircuitoAbierto as e:
+            # Destino caído: se reprograma sin gastar un intento
+            ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+            item.estado = "pendiente"
+            item.ultimo_error = str(e)
+            item.proximo_intento = ahora + timedelta(
+                seconds=max(e.segundos, BACKOFF_BASE_SEGUNDOS)
+            )
+            db.session.commit()
+            continue
+
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception(
+                f"Error entregando notificación {item.id}"
+            )
+            entregado = False
+            error = str(e)
+
+        _registrar_resultado(item, entregado, error)
+
+        # last_seen y endpoints muertos de este envío, en el mismo commit
+        guardar_estado_suscripciones()
+
+        db.session.commit()
+
+    return len(lote)
@@ -0,0 +1,163 @@
+# models/programador.py
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import text
+
+from models.base import db
+
+# ============================================================
+# 🔒 LLAVES DE ADVISORY LOCK (Postgres)
+# ============================================================
+# Líder: solo un worker/instancia corre el evaluador de alertas.
+LLAVE_LIDER = 73310001
+
+# Evaluación: una sola evaluación a la vez (hilo líder o /emergencia).
+LLAVE_EVALUACION = 73310002
+
+# Esquema: un solo proceso aplica los cambios de esquema al arrancar.
+LLAVE_ESQUEMA = 73310003
+
+# Resumen de tránsito: una sola reconstrucción a la vez (arranque o CLI).
+LLAVE_RESUMEN = 73310004
+
+# Cada cuánto un seguidor vuelve a intentar ser líder (failover)
+REINTENTO_LIDER_SEGUNDOS = 15
+
+
+def _usa_postgres() -> bool:
+    return db.engine.dialect.name == "postgresql"
+
+
+def _intentar_lock(conexion, llave: int) -> bool:
+    obtenido = conexion.execute(
+        text("SELECT pg_try_advisory_lock(:llave)"),
+        {"llave": llave},
+    ).scalar()
+
+    # El lock es de sesión: cerramos la transacción para no quedar
+    # "idle in transaction" mientras lo tenemos.
+    conexion.commit()
+
+    return bool(obtenido)
+
+
+class LiderAlertas:
+    """
+    Lease de líder basado en pg_try_advisory_lock.
+
+    El líder guarda una conexión dedicada que mantiene el lock. Si la
+    conexión se cae, Postgres libera el lock y otro worker lo toma en su
+    siguiente intento. En SQLite (local) siempre hay un solo proceso,
+    así que siempre es líder.
+    """
+
+    def __init__(self):
+        self._conexion = None
+
+    def _soltar(self):
+        if self._conexion is None:
+            return
+
+        try:
+            self._conexion.invalidate()
+            self._conexion.close()
+        except Exception:
+            pass
+
+        self._conexion = None
+
+    @property
+    def es_lider(self) -> bool:
+        """Si este proceso tiene el lease (sin ir a la BD a confirmarlo)."""
+        return not _usa_postgres() or self._conexion is not None
+
+    def mantener(self) -> bool:
+        """True si este proceso es el líder (lo confirma o lo intenta)."""
+        if not _usa_postgres():
+            return True
+
+        if self._conexion is not None:
+            try:
+                self._conexion.execute(text("SELECT 1"))
+                self._conexion.commit()
+                return True
+
+            except Exception:
+                current_app.logger.warning(
+                    "Se perdió la conexión del líder de alertas"
+                )
+                self._soltar()
+
+        conexion = None
+
+        try:
+            conexion = db.engine.connect()
+
+            if _intentar_lock(conexion, LLAVE_LIDER):
+                self._conexion = conexion
+                current_app.logger.info(
+                    "Este proceso es el líder de alertas"
+                )
+                return True
+
+            conexion.close()
+            return False
+
+        except Exception:
+            if conexion is not None:
+                try:
+                    conexion.invalidate()
+                    conexion.close()
+                except Exception:
+                    pass
+
+            current_app.logger.exception(
+                "No se pudo intentar el lock de líder"
+            )
+            return False
+
+
+_evaluacion_local = threading.Lock()
+
+
+@contextmanager
+def evaluacion_exclusiva():
+    """
+    Single-flight de la evaluación de alertas.
+
+    Entrega True si este llamado tiene el turno; False si ya hay una
+    evaluación corriendo (en este proceso o en cualquier otro).
+    """
+    if not _evaluacion_local.acquire(blocking=False):
+        yield False
+        return
+
+    conexion = None
+    obtenido = False
+
+    try:
+        if _usa_postgres():
+            conexion = db.engine.connect()
+            obtenido = _intentar_lock(conexion, LLAVE_EVALUACION)
+        else:
+            obtenido = True
+
+        yield obtenido
+
+    finally:
+        if conexion is not None:
+            try:
+                if obtenido:
+                    conexion.execute(
+                        text("SELECT pg_advisory_unlock(:llave)"),
+                        {"llave": LLAVE_EVALUACION},
+                    )
+                    conexion.commit()
+            except Exception:
+                conexion.invalidate()
+            finally:
+                conexion.close()
+
+        _evaluacion_local.release()
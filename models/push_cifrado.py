@@ -0,0 +1,124 @@
+# models/push_cifrado.py
+import base64
+import os
+import threading
+import time
+
+import http_ece
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
+
+# ============================================================
+# 🔐 CIFRADO DE DIFUSIÓN PARA WEB PUSH (RFC 8291, aes128gcm)
+# ============================================================
+# Cada alerta es el mismo payload para todas las suscripciones. pywebpush
+# repite por cada envío: llave efímera ECDH nueva, lectura de la llave
+# VAPID, firma del JWT y parseo del p256dh del suscriptor. Aquí:
+#
+# - La llave efímera se genera una vez por mensaje (difusión).
+# - El JWT VAPID se cachea por audiencia (origen del servicio de push)
+#   hasta que le falte poco para expirar.
+# - Las llaves públicas de los suscriptores se parsean una sola vez.
+# - Por suscriptor solo queda lo obligatorio: ECDH + HKDF + AES-GCM
+#   (con salt propio).
+
+# El JWT dura 12 horas; se renueva cuando le queda menos de 1 hora
+VAPID_DURACION_SEGUNDOS = 12 * 60 * 60
+VAPID_MARGEN_SEGUNDOS = 60 * 60
+
+MAX_LLAVES_CACHE = 2000
+
+_lock = threading.Lock()
+_vapid_por_llave = {}
+_jwt_por_audiencia = {}
+_llaves_suscriptor = {}
+
+
+def _b64_a_bytes(valor: str) -> bytes:
+    valor = valor.strip()
+    return base64.urlsafe_b64decode(valor + "=" * (-len(valor) % 4))
+
+
+def llave_suscriptor(p256dh: str) -> ec.EllipticCurvePublicKey:
+    """Llave pública del navegador, parseada una sola vez."""
+    llave = _llaves_suscriptor.get(p256dh)
+
+    if llave is None:
+        llave = ec.EllipticCurvePublicKey.from_encoded_point(
+            ec.SECP256R1(),
+            _b64_a_bytes(p256dh),
+        )
+
+        with _lock:
+            if len(_llaves_suscriptor) >= MAX_LLAVES_CACHE:
+                _llaves_suscriptor.clear()
+
+            _llaves_suscriptor[p256dh] = llave
+
+    return llave
+
+
+def encabezado_vapid(vapid_private: str, vapid_subject: str, audiencia: str) -> str:
+    """Header Authorization VAPID, firmado una vez por audiencia."""
+    ahora = int(time.time())
+    clave = (vapid_private, vapid_subject, audiencia)
+
+    with _lock:
+        cacheado = _jwt_por_audiencia.get(clave)
+
+        if cacheado and cacheado[1] - ahora > VAPID_MARGEN_SEGUNDOS:
+            return cacheado[0]
+
+        vapid = _vapid_por_llave.get(vapid_private)
+
+        if vapid is None:
+            vapid = Vapid.from_string(private_key=vapid_private)
+            _vapid_por_llave[vapid_private] = vapid
+
+        expira = ahora + VAPID_DURACION_SEGUNDOS
+
+        encabezado = vapid.sign({
+            "sub": vapid_subject,
+            "aud": audiencia,
+            "exp": expira,
+        })["Authorization"]
+
+        _jwt_por_audiencia[clave] = (encabezado, expira)
+
+        return encabezado
+
+
+class CifradorDifusion:
+    """Cifra un mismo payload para muchas suscripciones."""
+
+    def __init__(self, payload, vapid_private: str, vapid_subject: str):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        self.payload = payload
+        self.vapid_private = vapid_private
+        self.vapid_subject = vapid_subject
+
+        # Llave efímera de este mensaje, compartida por todos los destinos
+        self._llave_efimera = ec.generate_private_key(ec.SECP256R1())
+
+    def cifrar(self, p256dh: str, auth: str) -> bytes:
+        return http_ece.encrypt(
+            self.payload,
+            salt=os.urandom(16),
+            private_key=self._llave_efimera,
+            dh=llave_suscriptor(p256dh),
+            auth_secret=_b64_a_bytes(auth),
+            version="aes128gcm",
+        )
+
+    def encabezados(self, audiencia: str) -> dict:
+        return {
+            "Authorization": encabezado_vapid(
+                self.vapid_private,
+                self.vapid_subject,
+                audiencia,
+            ),
+            "Content-Encoding": "aes128gcm",
+            "TTL": "0",
+        }
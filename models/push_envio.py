@@ -0,0 +1,482 @@
+# models/push_envio.py
+import json
+import os
+from email.utils import parsedate_to_datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+import requests
+from sqlalchemy import or_
+from requests.adapters import HTTPAdapter
+from pywebpush import WebPushException
+
+from models.base import db
+from models.push_subscription import PushSubscription
+from models.push_cifrado import CifradorDifusion
+from models.circuitos import circuito, CERRADO, SEMIABIERTO
+
+# ============================================================
+# 📣 FAN-OUT DE WEB PUSH
+# ============================================================
+# Los envíos a cada suscripción son HTTP independientes: se hacen en un
+# pool acotado de hilos, con timeout por endpoint y una sesión keep-alive
+# por servicio de push (FCM, Mozilla, Apple...). La BD solo se toca en el
+# hilo que llama, nunca dentro del pool.
+
+PUSH_CONCURRENCIA = int(os.getenv("PUSH_CONCURRENCIA", "8"))
+PUSH_TIMEOUT_SEGUNDOS = float(os.getenv("PUSH_TIMEOUT_SEGUNDOS", "5"))
+
+# last_seen es informativo: se reescribe como mucho cada 10 minutos por
+# suscripción y se guarda en bloque cada minuto (write-behind).
+LAST_SEEN_GRANULARIDAD = timedelta(minutes=10)
+VACIADO_SEGUNDOS = 60
+
+_pool = None
+_sesiones = {}
+_lock = threading.Lock()
+
+# Backoff por endpoint: 30s, 60s, 120s... hasta 6 horas (o lo que pida
+# Retry-After si es más). Mientras está suspendida no se le envía nada.
+BACKOFF_BASE_SEGUNDOS = 30
+BACKOFF_MAX_SEGUNDOS = 6 * 60 * 60
+
+# 404/410: el endpoint ya no existe. Cualquier otro rechazo puede ser
+# pasajero (429, 5xx) o culpa nuestra (VAPID, payload): no se borra.
+ESTADOS_MUERTOS = {404, 410}
+
+_vistos = {}
+_muertas = set()
+_fallos = {}
+_vaciado_en = time.monotonic()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=PUSH_CONCURRENCIA,
+                thread_name_prefix="push",
+            )
+
+        return _pool
+
+
+def origen_de(endpoint: str) -> str:
+    url = urlparse(endpoint or "")
+    return f"{url.scheme}://{url.netloc}"
+
+
+def _sesion(origen: str) -> requests.Session:
+    """Una sesión (pool de conexiones keep-alive) por servicio de push."""
+    with _lock:
+        sesion = _sesiones.get(origen)
+
+        if sesion is None:
+            sesion = requests.Session()
+            adaptador = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=PUSH_CONCURRENCIA,
+            )
+            sesion.mount("https://", adaptador)
+            sesion.mount("http://", adaptador)
+            _sesiones[origen] = sesion
+
+        return sesion
+
+
+def segundos_retry_after(respuesta) -> float:
+    """Retry-After en segundos (acepta número o fecha HTTP); 0 si no viene."""
+    valor = (respuesta.headers.get("Retry-After") or "").strip()
+
+    if not valor:
+        return 0
+
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+
+    try:
+        fecha = parsedate_to_datetime(valor)
+        return max(0.0, (fecha - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0
+
+
+def _enviar_uno(destino, cifrador: CifradorDifusion):
+    sub_id, sub_info = destino
+    inicio = time.perf_counter()
+    estado = "ok"
+    retry_after = 0
+
+    try:
+        endpoint = sub_info["endpoint"]
+        origen = origen_de(endpoint)
+
+        try:
+            cuerpo = cifrador.cifrar(
+                sub_info["keys"]["p256dh"],
+                sub_info["keys"]["auth"],
+            )
+        except ValueError:
+            raise WebPushException("Llaves de la suscripción inválidas")
+
+        respuesta = _sesion(origen).post(
+            endpoint,
+            data=cuerpo,
+            headers=cifrador.encabezados(origen),
+            timeout=PUSH_TIMEOUT_SEGUNDOS,
+        )
+
+        if respuesta.status_code in ESTADOS_MUERTOS:
+            raise WebPushException(
+                f"Push failed: {respuesta.status_code} {respuesta.reason}",
+                response=respuesta,
+            )
+
+        if respuesta.status_code > 202:
+            # 429, 5xx u otro rechazo: backoff, la suscripción se conserva
+            estado = "error"
+            retry_after = segundos_retry_after(respuesta)
+
+    except WebPushException:
+        # Endpoint inexistente o llaves inválidas => suscripción muerta
+        estado = "muerto"
+
+    except Exception:
+        # Timeout o error de red: backoff, igual que un 5xx
+        estado = "error"
+
+    latencia_ms = (time.perf_counter() - inicio) * 1000
+
+    return sub_id, estado, latencia_ms, retry_after
+
+
+def _backoff_segundos(fallos: int, retry_after: float) -> float:
+    espera = min(
+        BACKOFF_MAX_SEGUNDOS,
+        BACKOFF_BASE_SEGUNDOS * (2 ** (fallos - 1)),
+    )
+    return max(espera, retry_after)
+
+
+def _estadisticas(latencias, total_ms) -> dict:
+    if not latencias:
+        return {"envios": 0, "total_ms": round(total_ms, 1)}
+
+    orden = sorted(latencias)
+
+    def percentil(p):
+        return round(orden[min(len(orden) - 1, int(len(orden) * p))], 1)
+
+    return {
+        "envios": len(orden),
+        "concurrencia": PUSH_CONCURRENCIA,
+        "p50_ms": percentil(0.50),
+        "p95_ms": percentil(0.95),
+        "max_ms": round(orden[-1], 1),
+        "total_ms": round(total_ms, 1),
+    }
+
+
+def enviar_a_suscripciones(subs, payload: str, vapid_private: str, vapid_subject: str) -> dict:
+    """
+    Envía el mismo payload a todas las suscripciones en paralelo.
+
+    last_seen de las que respondieron y los endpoints muertos quedan
+    anotados en memoria; guardar_estado_suscripciones() los escribe en bloque.
+    """
+    inicio = time.perf_counter()
+
+    destinos = [
+        (
+            s.id,
+            {
+                "endpoint": s.endpoint,
+                "keys": {
+                    "p256dh": s.p256dh,
+                    "auth": s.auth,
+                },
+            },
+        )
+        for s in subs
+    ]
+
+    # Llave efímera y JWT VAPID una vez por difusión, no por envío
+    cifrador = CifradorDifusion(payload, vapid_private, vapid_subject)
+
+    resultados = list(
+        _executor().map(
+            lambda d: _enviar_uno(d, cifrador),
+            destinos,
+        )
+    )
+
+    por_id = {s.id: s for s in subs}
+    enviados = 0
+    fallidos = 0
+    errores = 0
+    ahora = datetime.utcnow()
+
+    for sub_id, estado, _, _ in resultados:
+        # Un 404/410 también es una respuesta sana del servicio de push
+        circuito(
+            f"push {origen_de(por_id[sub_id].endpoint)}"
+        ).registrar(estado != "error")
+
+    with _lock:
+        for sub_id, estado, _, retry_after in resultados:
+            s = por_id[sub_id]
+
+            if estado == "ok":
+                enviados += 1
+
+                if s.last_seen is None or ahora - s.last_seen >= LAST_SEEN_GRANULARIDAD:
+                    _vistos[sub_id] = ahora
+
+                # Se recuperó: se limpia el contador
+                if s.fallos_consecutivos or sub_id in _fallos:
+                    _fallos[sub_id] = (0, None)
+                continue
+
+            fallidos += 1
+
+            if estado == "muerto":
+                _muertas.add(sub_id)
+                _fallos.pop(sub_id, None)
+                continue
+
+            errores += 1
+
+            previos = _fallos.get(sub_id, (s.fallos_consecutivos or 0, None))[0]
+            fallos = previos + 1
+
+            _fallos[sub_id] = (
+                fallos,
+                ahora + timedelta(seconds=_backoff_segundos(fallos, retry_after)),
+            )
+
+    return {
+        "enviados": enviados,
+        "fallidos": fallidos,
+        "errores": errores,
+        "latencia": _estadisticas(
+            [r[2] for r in resultados],
+            (time.perf_counter() - inicio) * 1000,
+        ),
+    }
+
+
+def guardar_estado_suscripciones(forzar: bool = False) -> dict:
+    """
+    Escribe lo anotado por los envíos (sin commit): un DELETE para todos los
+    endpoints muertos, un UPDATE en lote de los contadores de fallos y otro
+    de last_seen, este último a lo sumo cada VACIADO_SEGUNDOS salvo que se
+    fuerce.
+    """
+    global _vaciado_en
+
+    with _lock:
+        muertas = list(_muertas)
+        _muertas.clear()
+
+        fallos = dict(_fallos)
+        _fallos.clear()
+
+        vistos = {}
+
+        if forzar or time.monotonic() - _vaciado_en >= VACIADO_SEGUNDOS:
+            vistos = {
+                sub_id: visto
+                for sub_id, visto in _vistos.items()
+                if sub_id not in muertas
+            }
+            _vistos.clear()
+            _vaciado_en = time.monotonic()
+
+    tabla = PushSubscription.__table__
+
+    if muertas:
+        db.session.execute(
+            tabla.delete().where(tabla.c.id.in_(muertas))
+        )
+
+    if fallos:
+        db.session.execute(
+            tabla.update()
+            .where(tabla.c.id == db.bindparam("b_id"))
+            .values(
+                fallos_consecutivos=db.bindparam("b_fallos"),
+                suspendida_hasta=db.bindparam("b_hasta"),
+            ),
+            [
+                {"b_id": sub_id, "b_fallos": n, "b_hasta": hasta}
+                for sub_id, (n, hasta) in fallos.items()
+            ],
+        )
+
+    if vistos:
+        db.session.execute(
+            tabla.update()
+            .where(tabla.c.id == db.bindparam("b_id"))
+            .values(last_seen=db.bindparam("b_last_seen")),
+            [
+                {"b_id": sub_id, "b_last_seen": visto}
+                for sub_id, visto in vistos.items()
+            ],
+        )
+
+    return {
+        "borradas": len(muertas),
+        "fallos": len(fallos),
+        "last_seen": len(vistos),
+    }
+
+
+def resumen_push(texto: str, max_len: int = 180) -> str:
+    """El push falla si el payload es muy largo: mandamos un resumen."""
+    t = (texto or "").replace("*", "")
+    t = t.replace("\r", "\n")
+    t = " ".join(t.split())
+
+    if len(t) > max_len:
+        t = t[: max_len - 1] + "…"
+
+    return t
+
+
+def difundir_push(
+    titulo: str,
+    mensaje: str,
+    url: str = "/notificaciones/alerta",
+    origen: str = None,
+    excluir_origenes=(),
+) -> dict:
+    """
+    Envía un push a todas las suscripciones, o solo a las de un servicio de
+    push si se indica `origen`. Hace commit de la lectura de suscripciones
+    antes de enviar: llamar sin cambios pendientes en la sesión. Los servicios en
+    `excluir_origenes` no se tocan (ya tienen su propio item en el outbox).
+
+    Los servicios con el circuito abierto se saltan y vuelven en
+    "omitidos" ({origen: segundos para reintentar}) para reencolarlos.
+    Con el circuito semiabierto se prueba con una sola suscripción: si
+    responde, el resto sale en esta misma difusión; si no, va a "omitidos".
+    """
+    vacio = {"enviados": 0, "fallidos": 0, "errores": 0, "omitidos": {}}
+
+    vapid_private = os.getenv("VAPID_PRIVATE_KEY", "")
+    vapid_subject = os.getenv("VAPID_SUBJECT", "mailto:ti@alamo.com")
+
+    if not vapid_private:
+        return vacio
+
+    ahora = datetime.utcnow()
+
+    with _lock:
+        # Anotado en memoria y todavía sin guardar
+        omitir = set(_muertas) | {
+            sub_id
+            for sub_id, (_, hasta) in _fallos.items()
+            if hasta and hasta > ahora
+        }
+
+    # Las suspendidas por backoff se filtran en la consulta: no cuestan
+    # un viaje HTTP en cada difusión
+    consulta = PushSubscription.query.filter(
+        or_(
+            PushSubscription.suspendida_hasta.is_(None),
+            PushSubscription.suspendida_hasta <= ahora,
+        )
+    )
+
+    if origen:
+        consulta = consulta.filter(PushSubscription.endpoint.like(f"{origen}/%"))
+
+    suscripciones = consulta.all()
+
+    # Se sueltan de la sesión (quedan con lo ya leído) y se cierra la
+    # transacción: no queda abierta y ociosa durante los envíos por red
+    for s in suscripciones:
+        db.session.expunge(s)
+
+    db.session.commit()
+
+    por_origen = {}
+
+    for s in suscripciones:
+        nombre = origen_de(s.endpoint)
+
+        if s.id not in omitir and nombre not in excluir_origenes:
+            por_origen.setdefault(nombre, []).append(s)
+
+    subs = []
+    omitidos = {}
+    pruebas = {}
+
+    for nombre, grupo in por_origen.items():
+        c = circuito(f"push {nombre}")
+
+        if not c.permitir():
+            omitidos[nombre] = c.segundos_para_reintentar()
+        elif c.estado == SEMIABIERTO:
+            # Semiabierto: una sola suscripción como prueba, no todo el origen
+            pruebas[nombre] = (grupo[0], grupo[1:])
+        else:
+            subs.extend(grupo)
+
+    if not subs and not pruebas:
+        return {**vacio, "omitidos": omitidos}
+
+    payload = json.dumps({
+        "title": titulo,
+        "body": resumen_push(mensaje),
+        "url": url or "/notificaciones/alerta",
+    })
+
+    enviados_prueba = {"enviados": 0, "fallidos": 0, "errores": 0}
+
+    if pruebas:
+        # Las pruebas van primero y solas: si el servicio sigue caído solo
+        # se espera un timeout, y el resto del origen se reencola (la
+        # prueba falló, así que nadie lo recibe dos veces)
+        enviados_prueba = enviar_a_suscripciones(
+            [prueba for prueba, _ in pruebas.values()],
+            payload,
+            vapid_private,
+            vapid_subject,
+        )
+
+        for nombre, (_, resto) in pruebas.items():
+            c = circuito(f"push {nombre}")
+
+            if c.estado == CERRADO:
+                subs.extend(resto)
+            elif resto:
+                omitidos[nombre] = c.segundos_para_reintentar()
+
+    if not subs:
+        return {
+            **vacio,
+            **{k: enviados_prueba[k] for k in ("enviados", "fallidos", "errores")},
+            "omitidos": omitidos,
+        }
+
+    resultado = enviar_a_suscripciones(
+        subs,
+        payload,
+        vapid_private,
+        vapid_subject,
+    )
+
+    for k in ("enviados", "fallidos", "errores"):
+        resultado[k] += enviados_prueba[k]
+
+    resultado["omitidos"] = omitidos
+
+    return resultado
@@ -10,4 +10,8 @@ class PushSubscription(db.Model):
     p256dh = db.Column(db.Text, nullable=False)
     auth = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    last_seen = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
\ No newline at end of file
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    # Backoff por endpoint ante 429/5xx/red (hora UTC, como last_seen)
+    fallos_consecutivos = db.Column(db.Integer, default=0, nullable=False)
+    suspendida_hasta = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,235 @@
+# models/registro_viajes.py
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+CR_TZ = pytz.timezone("America/Costa_Rica")
+
+# Después de la primera alerta se vuelve a notificar cada 4 minutos
+INTERVALO_RENOTIFICAR = timedelta(minutes=4)
+
+
+def normalizar_tipo(tipo_operacion) -> str:
+    """Todo lo que no sea importación se trata como exportación."""
+    tipo = (tipo_operacion or "").strip().lower()
+    return "importacion" if tipo == "importacion" else "exportacion"
+
+
+def calcular_vencimiento(hora_salida, tipo_operacion, ultima_notificacion,
+                         min_import: int, min_export: int) -> datetime:
+    """
+    Próxima alerta de un viaje: el cruce del umbral de su tipo o, si ya se
+    notificó, 4 minutos después de la última notificación.
+    """
+    umbral = min_import if normalizar_tipo(tipo_operacion) == "importacion" else min_export
+    vence = hora_salida + timedelta(minutes=umbral)
+
+    if ultima_notificacion:
+        vence = max(vence, ultima_notificacion + INTERVALO_RENOTIFICAR)
+
+    return vence
+
+
+class RegistroViajes:
+    """
+    Viajes en ruta de este proceso, ordenados por su próxima alerta.
+
+    Cada viaje tiene un vencimiento: primero el cruce del umbral
+    (importación / exportación) y luego cada 4 minutos desde la última
+    notificación. Los vencimientos viven en un min-heap, así que el
+    evaluador solo despierta cuando algo vence y solo toca esos viajes.
+
+    Las entradas del heap que quedan viejas (viaje cerrado o reprogramado)
+    se descartan al salir, comparando contra el vencimiento vigente.
+    """
+
+    def __init__(self, min_import=20, min_export=30):
+        self._cond = threading.Condition()
+        self._viajes = {}
+        self._heap = []
+
+        self.min_import = min_import
+        self.min_export = min_export
+
+        # Momento (time.monotonic) de la última carga completa desde BD
+        self.cargado_en = None
+
+        # Última vez que se comparó la firma contra la BD (ver firma())
+        self.revisado_en = None
+
+    # ------------------------------------------------------------
+    # Cálculo de vencimientos
+    # ------------------------------------------------------------
+    def umbral(self, tipo: str) -> int:
+        return self.min_import if tipo == "importacion" else self.min_export
+
+    def _vencimiento(self, viaje: dict) -> datetime:
+        return calcular_vencimiento(
+            viaje["hora_salida"],
+            viaje["tipo"],
+            viaje["ultima_notificacion"],
+            self.min_import,
+            self.min_export,
+        )
+
+    def _programar(self, mov_id: int, viaje: dict):
+        viaje["vence_en"] = self._vencimiento(viaje)
+        self._viajes[mov_id] = viaje
+        heapq.heappush(self._heap, (viaje["vence_en"], mov_id))
+
+    # ------------------------------------------------------------
+    # Cambios desde rutas / evaluador
+    # ------------------------------------------------------------
+    def cargar(self, viajes, min_import: int, min_export: int):
+        """
+        Reemplaza todo el registro.
+        `viajes` son tuplas (id, hora_salida, ultima_notificacion, tipo_operacion).
+        """
+        with self._cond:
+            self.min_import = min_import
+            self.min_export = min_export
+            self._viajes = {}
+            self._heap = []
+
+            for mov_id, hora_salida, ultima_notificacion, tipo_operacion in viajes:
+                if not hora_salida:
+                    continue
+
+                self._programar(mov_id, {
+                    "hora_salida": hora_salida,
+                    "ultima_notificacion": ultima_notificacion,
+                    "tipo": normalizar_tipo(tipo_operacion),
+                })
+
+            self.cargado_en = time.monotonic()
+            self.revisado_en = self.cargado_en
+            self._cond.notify_all()
+
+    def registrar(self, mov_id: int, hora_salida, tipo_operacion, ultima_notificacion=None):
+        if not hora_salida:
+            return
+
+        with self._cond:
+            self._programar(mov_id, {
+                "hora_salida": hora_salida,
+                "ultima_notificacion": ultima_notificacion,
+                "tipo": normalizar_tipo(tipo_operacion),
+            })
+            self._cond.notify_all()
+
+    def quitar(self, mov_id: int):
+        with self._cond:
+            self._viajes.pop(mov_id, None)
+
+    def marcar_notificado(self, mov_id: int, ahora: datetime):
+        with self._cond:
+            viaje = self._viajes.get(mov_id)
+
+            if viaje:
+                viaje["ultima_notificacion"] = ahora
+                self._programar(mov_id, viaje)
+
+    def configurar_umbrales(self, min_import: int, min_export: int):
+        """Recalcula todos los vencimientos cuando cambian los tiempos."""
+        with self._cond:
+            self.min_import = min_import
+            self.min_export = min_export
+            self._heap = []
+
+            for mov_id, viaje in self._viajes.items():
+                self._programar(mov_id, viaje)
+
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------
+    # Consultas del evaluador
+    # ------------------------------------------------------------
+    def _limpiar_tope(self):
+        while self._heap:
+            vence_en, mov_id = self._heap[0]
+            viaje = self._viajes.get(mov_id)
+
+            if viaje and viaje["vence_en"] == vence_en:
+                return
+
+            heapq.heappop(self._heap)
+
+    def proximo_vencimiento(self):
+        with self._cond:
+            self._limpiar_tope()
+            return self._heap[0][0] if self._heap else None
+
+    def vencidos(self, ahora: datetime) -> list:
+        """Ids de los viajes cuya próxima alerta ya venció (sin sacarlos)."""
+        with self._cond:
+            self._limpiar_tope()
+
+            vencidos = []
+            pendientes = []
+
+            while self._heap and self._heap[0][0] <= ahora:
+                vence_en, mov_id = heapq.heappop(self._heap)
+                viaje = self._viajes.get(mov_id)
+
+                if viaje and viaje["vence_en"] == vence_en:
+                    vencidos.append(mov_id)
+                    pendientes.append((vence_en, mov_id))
+
+            for entrada in pendientes:
+                heapq.heappush(self._heap, entrada)
+
+            return vencidos
+
+    def segundos_hasta_proximo(self, ahora: datetime, maximo: float) -> float:
+        proximo = self.proximo_vencimiento()
+
+        if proximo is None:
+            return maximo
+
+        return max(0.0, min(maximo, (proximo - ahora).total_seconds()))
+
+    def esperar(self, segundos: float):
+        """Duerme hasta `segundos` o hasta que el registro cambie."""
+        with self._cond:
+            self._cond.wait(timeout=segundos)
+
+    def necesita_carga(self, cada_segundos: float) -> bool:
+        return (
+            self.cargado_en is None
+            or time.monotonic() - self.cargado_en >= cada_segundos
+        )
+
+    def invalidar(self):
+        """Fuerza una carga completa en la próxima evaluación."""
+        with self._cond:
+            self.cargado_en = None
+            self._cond.notify_all()
+
+    def toca_revisar(self, cada_segundos: float) -> bool:
+        """True (y anota la revisión) si pasaron `cada_segundos` desde la última."""
+        with self._cond:
+            ahora = time.monotonic()
+
+            if self.revisado_en is not None and ahora - self.revisado_en < cada_segundos:
+                return False
+
+            self.revisado_en = ahora
+            return True
+
+    def firma(self) -> tuple:
+        """
+        (cantidad, suma de ids) de los viajes registrados: igual a la de los
+        viajes en ruta en BD mientras nadie cree o cierre uno en otro proceso.
+        """
+        with self._cond:
+            return len(self._viajes), sum(self._viajes)
+
+    def __len__(self):
+        return len(self._viajes)
+
+
+# Instancia única por proceso
+registro_viajes = RegistroViajes()
@@ -0,0 +1,184 @@
+# models/resumen_transito.py
+from datetime import datetime
+
+import pytz
+from sqlalchemy.dialects.postgresql import insert as insert_postgres
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+
+from models.base import db
+from models.movimiento import MovimientoBarco
+from models.programador import LLAVE_RESUMEN
+
+CR_TZ = pytz.timezone("America/Costa_Rica")
+
+
+class ResumenTransito(db.Model):
+    """
+    Acumulado de duraciones de viajes finalizados por placa.
+
+    El reporte de choferes en tránsito agrupa estas filas (una por placa)
+    por propietario en lugar de recorrer todo movimientos_barco. Se suma
+    cada viaje al cerrarlo, en la misma transacción del cierre.
+    """
+
+    __tablename__ = "resumen_transito_placas"
+    __table_args__ = {"schema": "operacionbarco"}
+
+    placa_id = db.Column(
+        db.Integer,
+        db.ForeignKey("operacionbarco.placas.id"),
+        primary_key=True,
+    )
+
+    viajes = db.Column(db.Integer, nullable=False, default=0)
+    suma_segundos = db.Column(db.Float, nullable=False, default=0)
+    min_segundos = db.Column(db.Float, nullable=True)
+    max_segundos = db.Column(db.Float, nullable=True)
+
+    actualizado_en = db.Column(
+        db.DateTime,
+        default=lambda: datetime.now(CR_TZ).replace(tzinfo=None),
+    )
+
+
+# ============================================================
+# ➕ SUMAR UN VIAJE AL CERRARLO
+# ============================================================
+
+def sumar_viaje_al_resumen(movimiento):
+    """
+    Suma la duración de un movimiento recién finalizado (sin commit).
+
+    Un solo INSERT ... ON CONFLICT DO UPDATE: la fila de la placa se crea
+    con el primer viaje y luego solo se actualiza.
+    """
+    segundos = movimiento.duracion_segundos
+
+    if segundos is None:
+        return
+
+    ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+
+    # LEAST/GREATEST en Postgres; en SQLite min()/max() con dos argumentos
+    if db.engine.dialect.name == "postgresql":
+        insert, menor, mayor = insert_postgres, db.func.least, db.func.greatest
+    else:
+        insert, menor, mayor = insert_sqlite, db.func.min, db.func.max
+
+    tabla = ResumenTransito.__table__
+
+    sentencia = insert(tabla).values(
+        placa_id=movimiento.placa_id,
+        viajes=1,
+        suma_segundos=segundos,
+        min_segundos=segundos,
+        max_segundos=segundos,
+        actualizado_en=ahora,
+    )
+
+    sentencia = sentencia.on_conflict_do_update(
+        index_elements=[tabla.c.placa_id],
+        set_={
+            "viajes": tabla.c.viajes + 1,
+            "suma_segundos": tabla.c.suma_segundos + segundos,
+            "min_segundos": menor(db.func.coalesce(tabla.c.min_segundos, segundos), segundos),
+            "max_segundos": mayor(db.func.coalesce(tabla.c.max_segundos, segundos), segundos),
+            "actualizado_en": ahora,
+        },
+    )
+
+    db.session.execute(sentencia)
+
+
+# ============================================================
+# 🔁 RECONSTRUIR (backfill / corrección)
+# ============================================================
+
+def _bloquear_resumen(esperar: bool) -> bool:
+    """
+    Lock de transacción (se suelta con el commit) para reconstruir de a
+    uno. Con esperar=False retorna False si otro proceso lo tiene.
+    """
+    if db.engine.dialect.name != "postgresql":
+        return True
+
+    if esperar:
+        db.session.execute(
+            db.text("SELECT pg_advisory_xact_lock(:llave)"),
+            {"llave": LLAVE_RESUMEN},
+        )
+        return True
+
+    return bool(
+        db.session.execute(
+            db.text("SELECT pg_try_advisory_xact_lock(:llave)"),
+            {"llave": LLAVE_RESUMEN},
+        ).scalar()
+    )
+
+
+def llenar_resumen_si_vacio() -> int:
+    """
+    Backfill del arranque (sin commit): solo si la tabla está vacía y
+    ningún otro worker la está llenando. Devuelve las placas insertadas.
+    """
+    if not _bloquear_resumen(esperar=False):
+        return 0
+
+    if db.session.query(ResumenTransito.placa_id).first():
+        return 0
+
+    return reconstruir_resumen_transito()
+
+
+def reconstruir_resumen_transito() -> int:
+    """
+    Recalcula el resumen completo desde movimientos_barco (sin commit).
+
+    Borra y vuelve a insertar con un solo INSERT ... SELECT agrupado sobre
+    duracion_segundos. Devuelve la cantidad de placas en el resumen.
+    Espera el lock del resumen; ON CONFLICT DO NOTHING cubre la fila que
+    un cierre simultáneo alcance a crear.
+    """
+    _bloquear_resumen(esperar=True)
+
+    duracion = MovimientoBarco.duracion_segundos
+    ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+
+    agregado = (
+        db.select(
+            MovimientoBarco.placa_id,
+            db.func.count(MovimientoBarco.id),
+            db.func.sum(duracion),
+            db.func.min(duracion),
+            db.func.max(duracion),
+            db.literal(ahora),
+        )
+        .where(
+            MovimientoBarco.estado == "finalizado",
+            MovimientoBarco.duracion_segundos.isnot(None),
+        )
+        .group_by(MovimientoBarco.placa_id)
+    )
+
+    tabla = ResumenTransito.__table__
+
+    db.session.execute(tabla.delete())
+
+    insert = insert_postgres if db.engine.dialect.name == "postgresql" else insert_sqlite
+
+    resultado = db.session.execute(
+        insert(tabla).from_select(
+            [
+                tabla.c.placa_id,
+                tabla.c.viajes,
+                tabla.c.suma_segundos,
+                tabla.c.min_segundos,
+                tabla.c.max_segundos,
+                tabla.c.actualizado_en,
+            ],
+            agregado,
+        ).on_conflict_do_nothing(index_elements=[tabla.c.placa_id])
+    )
+
+    return resultado.rowcount
@@ -1,3 +1,6 @@
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime
 from models.base import db
 
@@ -11,5 +14,90 @@ class ConfigTiempos(db.Model):
     min_import = db.Column(db.Integer, nullable=False, default=20)
     min_export = db.Column(db.Integer, nullable=False, default=30)
 
+    # Se incrementa en cada guardado; los caches de otros workers lo comparan
+    version = db.Column(db.Integer, nullable=False, default=1)
+
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    updated_by = db.Column(db.Integer, nullable=True)
\ No newline at end of file
+    updated_by = db.Column(db.Integer, nullable=True)
+
+
+# ============================================================
+# ⚡ CACHE DE TIEMPOS (por proceso, versionado)
+# ============================================================
+
+Umbrales = namedtuple("Umbrales", ["version", "min_import", "min_export"])
+
+# Sin guardados locales, cada cuánto se revisa si otro worker cambió la config
+REVALIDAR_SEGUNDOS = 30
+
+
+class CacheTiempos:
+    """
+    Umbrales vigentes sin ir a Postgres en cada tick.
+
+    guardar_tiempos() invalida el cache de su proceso al instante; los demás
+    procesos consultan solo la versión a lo sumo cada 30 segundos y releen
+    los umbrales únicamente si cambió.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._umbrales = None
+        self._leido_en = None
+
+    def obtener(self) -> Umbrales:
+        with self._lock:
+            umbrales = self._umbrales
+
+            if (
+                umbrales is not None
+                and time.monotonic() - self._leido_en < REVALIDAR_SEGUNDOS
+            ):
+                return umbrales
+
+        # Revalidación: primero solo la versión; la fila completa se relee
+        # únicamente si otro worker guardó cambios
+        if umbrales is not None:
+            version = (
+                db.session.query(ConfigTiempos.version)
+                .order_by(ConfigTiempos.id.desc())
+                .limit(1)
+                .scalar()
+            )
+
+            # Sin fila la versión en cache es 0 (valores por defecto)
+            if (version or 0) == umbrales.version:
+                with self._lock:
+                    self._leido_en = time.monotonic()
+
+                return umbrales
+
+        fila = (
+            db.session.query(
+                ConfigTiempos.version,
+                ConfigTiempos.min_import,
+                ConfigTiempos.min_export,
+            )
+            .order_by(ConfigTiempos.id.desc())
+            .first()
+        )
+
+        umbrales = (
+            Umbrales(fila.version or 1, fila.min_import, fila.min_export)
+            if fila
+            else Umbrales(0, 20, 30)
+        )
+
+        with self._lock:
+            self._umbrales = umbrales
+            self._leido_en = time.monotonic()
+
+        return umbrales
+
+    def invalidar(self):
+        with self._lock:
+            self._umbrales = None
+            self._leido_en = None
+
+
+tiempos_cache = CacheTiempos()
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytz
 
@@ -9,6 +9,8 @@ from flask import (
     flash,
     jsonify,
     current_app,
+    redirect,
+    url_for,
 )
 
 from flask_login import login_required, current_user
@@ -17,8 +19,12 @@ from sqlalchemy.orm import joinedload
 from sqlalchemy import text
 
 from models.base import db
+from models.exportacion import responder_exportacion, FILAS_POR_TANDA
 from models.movimiento import MovimientoBarco
 from models.operacion import Operacion
+from models.registro_viajes import registro_viajes
+from models.resumen_transito import sumar_viaje_al_resumen
+from routes.notificacion_routes import revisar_orden_incorrecto
 
 
 CR_TZ = pytz.timezone("America/Costa_Rica")
@@ -136,12 +142,38 @@ def registrar_llegada_movimiento(id):
                 "duracion_minutos": round(minutos, 2)
             }), 400
 
-        movimiento.hora_llegada = hora_llegada
-        movimiento.estado = "finalizado"
-        movimiento.cerrado_por_user_id = current_user.id
+        # Solo el cierre que gana suma al resumen y revisa el orden
+        if not movimiento.cerrar(hora_llegada, current_user.id):
+            db.session.rollback()
+
+            return jsonify({
+                "mensaje": "El movimiento ya fue finalizado"
+            }), 200
+
+        # Alertas de orden incorrecto y resumen del reporte de choferes en
+        # la misma transacción, cada uno en un savepoint: si fallan, el
+        # cierre igual se guarda (el resumen se rehace con el comando
+        # `flask reconstruir-resumen-transito`)
+        try:
+            with db.session.begin_nested():
+                revisar_orden_incorrecto(movimiento)
+        except Exception as e:
+            current_app.logger.exception(
+                f"Error revisando orden incorrecto del movimiento {movimiento.id}: {e}"
+            )
+
+        try:
+            with db.session.begin_nested():
+                sumar_viaje_al_resumen(movimiento)
+        except Exception as e:
+            current_app.logger.exception(
+                f"Error sumando el movimiento {movimiento.id} al resumen: {e}"
+            )
 
         db.session.commit()
 
+        registro_viajes.quitar(movimiento.id)
+
         return jsonify({
             "mensaje":
                 f"Movimiento {movimiento.contenedor} "
@@ -160,79 +192,226 @@ def registrar_llegada_movimiento(id):
         }), 500
 
 
+# ============================================================
+# 📄 PAGINACIÓN DE REPORTES (keyset)
+# ============================================================
+# "Siguientes" continúa desde la última fila mostrada (cursor `antes`), así
+# cualquier página cuesta lo mismo que la primera. El total sale de un
+# COUNT(*) OVER() en la misma consulta de la primera página y las
+# siguientes lo reciben en el enlace (`total`), junto con cuántas filas
+# ya se mostraron (`n`) para numerar.
+
+def _leer_cursor_llegada(valor):
+    """Cursor "<hora_llegada ISO>_<id>" de la última fila mostrada, o None."""
+    try:
+        llegada, mov_id = (valor or "").rsplit("_", 1)
+        return datetime.fromisoformat(llegada), int(mov_id)
+    except ValueError:
+        return None
+
+
+def _leer_cursor_chofer(valor):
+    """Cursor "<promedio>_<chofer>" de la última fila mostrada, o None."""
+    try:
+        promedio, chofer = (valor or "").split("_", 1)
+        return float(promedio), chofer
+    except ValueError:
+        return None
+
+
+def _paginar(filas, por_pagina, total):
+    """Recorta la fila extra de la consulta y toma el total de la ventana."""
+    registros = filas[:por_pagina]
+
+    if total is None:
+        total = registros[0]["total"] if registros else 0
+
+    return registros, len(filas) > por_pagina, total
+
+
+# ============================================================
+# 🔎 FILTROS DE REPORTES (rango de llegada / operación)
+# ============================================================
+# Con filtros, las consultas solo tocan los movimientos del rango por los
+# índices (estado, hora_llegada) y (operacion_id, hora_llegada).
+
+def _filtros_reporte():
+    """desde / hasta (fechas de llegada, AAAA-MM-DD) y operacion_id de la URL."""
+    filtros = {}
+
+    for campo in ("desde", "hasta"):
+        valor = (request.args.get(campo) or "").strip()
+
+        try:
+            datetime.strptime(valor, "%Y-%m-%d")
+            filtros[campo] = valor
+        except ValueError:
+            pass
+
+    operacion_id = request.args.get("operacion_id", type=int)
+
+    if operacion_id:
+        filtros["operacion_id"] = operacion_id
+
+    return filtros
+
+
+def _condiciones_reporte(filtros):
+    """Condiciones SQL sobre movimientos_barco (alias m) y sus parámetros."""
+    condiciones = []
+    params = {}
+
+    if "desde" in filtros:
+        condiciones.append("m.hora_llegada >= :desde")
+        params["desde"] = datetime.strptime(filtros["desde"], "%Y-%m-%d")
+
+    # "hasta" incluye todo ese día
+    if "hasta" in filtros:
+        condiciones.append("m.hora_llegada < :hasta")
+        params["hasta"] = datetime.strptime(filtros["hasta"], "%Y-%m-%d") + timedelta(days=1)
+
+    if "operacion_id" in filtros:
+        condiciones.append("m.operacion_id = :operacion_id")
+        params["operacion_id"] = filtros["operacion_id"]
+
+    return condiciones, params
+
+
+def _operaciones_para_filtro():
+    return (
+        db.session.query(Operacion.id, Operacion.nombre)
+        .order_by(Operacion.fecha_creacion.desc())
+        .all()
+    )
+
+
 # ============================================================
 # 📊 REPORTE: CHOFERES QUE MÁS DURAN EN TRÁNSITO
 # ============================================================
+# Sin filtros lee el resumen por placa (una fila por placa, se mantiene al
+# finalizar cada movimiento). El resumen es de todo el historial: con rango
+# de fechas u operación se agrega en vivo solo sobre los movimientos del
+# rango, por índice.
+
+_CHOFERES_DESDE_RESUMEN = """
+    SELECT
+        COALESCE(p.propietario, 'No registrado') AS chofer,
+        SUM(r.viajes) AS total_viajes,
+        ROUND(
+            CAST(SUM(r.suma_segundos) / SUM(r.viajes) / 60 AS NUMERIC),
+            2
+        ) AS promedio_minutos,
+        ROUND(
+            CAST(MAX(r.max_segundos) / 60 AS NUMERIC),
+            2
+        ) AS mayor_duracion_minutos,
+        ROUND(
+            CAST(MIN(r.min_segundos) / 60 AS NUMERIC),
+            2
+        ) AS menor_duracion_minutos
+    FROM operacionbarco.resumen_transito_placas r
+    JOIN operacionbarco.placas p
+        ON p.id = r.placa_id
+    WHERE r.viajes > 0
+    GROUP BY p.propietario
+"""
+
+_CHOFERES_EN_VIVO = """
+    SELECT
+        COALESCE(p.propietario, 'No registrado') AS chofer,
+        COUNT(m.id) AS total_viajes,
+        ROUND(
+            CAST(AVG(m.duracion_segundos) / 60.0 AS NUMERIC),
+            2
+        ) AS promedio_minutos,
+        ROUND(
+            CAST(MAX(m.duracion_segundos) / 60.0 AS NUMERIC),
+            2
+        ) AS mayor_duracion_minutos,
+        ROUND(
+            CAST(MIN(m.duracion_segundos) / 60.0 AS NUMERIC),
+            2
+        ) AS menor_duracion_minutos
+    FROM operacionbarco.movimientos_barco m
+    JOIN operacionbarco.placas p
+        ON p.id = m.placa_id
+    WHERE {condiciones}
+    GROUP BY p.propietario
+"""
+
+ORDEN_CHOFERES = "ORDER BY x.promedio_minutos DESC, x.chofer DESC"
+
+
+def _agregado_choferes(filtros):
+    """Subconsulta (una fila por chofer) y sus parámetros según los filtros."""
+    condiciones, params = _condiciones_reporte(filtros)
+
+    if not condiciones:
+        return _CHOFERES_DESDE_RESUMEN, params
+
+    condiciones = [
+        "m.estado = 'finalizado'",
+        "m.duracion_segundos IS NOT NULL",
+    ] + condiciones
+
+    return _CHOFERES_EN_VIVO.format(condiciones=" AND ".join(condiciones)), params
+
+
 @movimiento_bp.route("/reportes/choferes-transito", methods=["GET"])
 @login_required
 def reporte_choferes_transito():
 
+    filtros = _filtros_reporte()
+
     try:
-        page = request.args.get("page", 1, type=int)
         per_page = 25
-        offset = (page - 1) * per_page
-
-        total_query = text("""
-            SELECT COUNT(*) AS total
-            FROM (
-                SELECT p.propietario
-                FROM operacionbarco.movimientos_barco m
-                JOIN operacionbarco.placas p
-                    ON p.id = m.placa_id
-                WHERE m.estado = 'finalizado'
-                  AND m.hora_llegada IS NOT NULL
-                  AND m.hora_salida IS NOT NULL
-                GROUP BY p.propietario
-            ) x
-        """)
+        cursor = _leer_cursor_chofer(request.args.get("antes"))
+        total = request.args.get("total", type=int) if cursor else None
+        mostrados = request.args.get("n", 0, type=int) if cursor else 0
+
+        agregado, params = _agregado_choferes(filtros)
+        params["limit"] = per_page + 1
+
+        condicion_cursor = ""
+
+        if cursor:
+            condicion_cursor = "WHERE (x.promedio_minutos, x.chofer) < (:promedio, :chofer)"
+            params["promedio"], params["chofer"] = cursor
 
-        data_query = text("""
-            SELECT
-                COALESCE(p.propietario, 'No registrado') AS chofer,
-                COUNT(m.id) AS total_viajes,
-                ROUND(
-                    AVG(EXTRACT(EPOCH FROM (m.hora_llegada - m.hora_salida)) / 60),
-                    2
-                ) AS promedio_minutos,
-                ROUND(
-                    MAX(EXTRACT(EPOCH FROM (m.hora_llegada - m.hora_salida)) / 60),
-                    2
-                ) AS mayor_duracion_minutos,
-                ROUND(
-                    MIN(EXTRACT(EPOCH FROM (m.hora_llegada - m.hora_salida)) / 60),
-                    2
-                ) AS menor_duracion_minutos
-            FROM operacionbarco.movimientos_barco m
-            JOIN operacionbarco.placas p
-                ON p.id = m.placa_id
-            WHERE m.estado = 'finalizado'
-              AND m.hora_llegada IS NOT NULL
-              AND m.hora_salida IS NOT NULL
-            GROUP BY p.propietario
-            ORDER BY promedio_minutos DESC
-            LIMIT :limit OFFSET :offset
+        # Total en la misma consulta, solo cuando no viene en el enlace
+        contar = ", COUNT(*) OVER() AS total" if total is None else ""
+
+        data_query = text(f"""
+            SELECT x.*{contar}
+            FROM ({agregado}) x
+            {condicion_cursor}
+            {ORDEN_CHOFERES}
+            LIMIT :limit
         """)
 
-        total = db.session.execute(total_query).scalar() or 0
+        filas = db.session.execute(data_query, params).mappings().all()
+
+        registros, hay_mas, total = _paginar(filas, per_page, total)
 
-        registros = db.session.execute(
-            data_query,
-            {
-                "limit": per_page,
-                "offset": offset
-            }
-        ).mappings().all()
+        siguiente = None
 
-        pages = (total + per_page - 1) // per_page
+        if hay_mas:
+            ultima = registros[-1]
+            siguiente = f"{ultima['promedio_minutos']}_{ultima['chofer']}"
 
         return render_template(
             "reporte_choferes_transito.html",
             registros=registros,
-            page=page,
-            pages=pages
+            siguiente=siguiente,
+            total=total,
+            mostrados=mostrados,
+            filtros=filtros,
+            operaciones=_operaciones_para_filtro()
         )
 
     except Exception as e:
+        db.session.rollback()
+
         current_app.logger.exception(
             f"Error en reporte de choferes en tránsito: {e}"
         )
@@ -245,90 +424,249 @@ def reporte_choferes_transito():
         return render_template(
             "reporte_choferes_transito.html",
             registros=[],
-            page=1,
-            pages=0
+            siguiente=None,
+            total=0,
+            mostrados=0,
+            filtros=filtros,
+            operaciones=[]
         )
 
 
 # ============================================================
-# 🚨 REPORTE: VIAJES MENORES A 10 MINUTOS
+# 🚨 REPORTE: VIAJES MENORES A 10 MINUTOS (o más largos que N)
 # ============================================================
+# Filtra por duracion_segundos (guardada al finalizar): el índice
+# (duracion_segundos, hora_llegada DESC) resuelve el rango.
+
+MINUTOS_VIAJE_CORTO = 10
+
+CONDICION_DURACION = {
+    "cortos": "m.duracion_segundos < :segundos",
+    "largos": "m.duracion_segundos >= :segundos",
+}
+
+_VIAJES_POR_DURACION = """
+    SELECT
+        m.id,
+        p.numero_placa,
+        COALESCE(p.propietario, 'No registrado') AS chofer,
+        m.contenedor,
+        m.hora_salida,
+        m.hora_llegada,
+        ROUND(m.duracion_segundos / 60.0, 2) AS duracion_minutos,
+        COALESCE(u.nombre, u.email, 'No registrado') AS cerrado_por
+        {contar}
+    FROM operacionbarco.movimientos_barco m
+    JOIN operacionbarco.placas p
+        ON p.id = m.placa_id
+    LEFT JOIN operacionbarco.usuarios u
+        ON u.id = m.cerrado_por_user_id
+    WHERE {condiciones}
+    ORDER BY m.hora_llegada DESC, m.id DESC
+"""
+
+
+def _filtros_viajes():
+    """Umbral (minutos), cortos/largos y los filtros comunes de reportes."""
+    minutos = max(request.args.get("minutos", MINUTOS_VIAJE_CORTO, type=int) or 1, 1)
+    tipo = request.args.get("tipo", "cortos")
+
+    if tipo not in CONDICION_DURACION:
+        tipo = "cortos"
+
+    return {"minutos": minutos, "tipo": tipo, **_filtros_reporte()}
+
+
+def _condiciones_viajes(filtros):
+    condiciones, params = _condiciones_reporte(filtros)
+    condiciones = ["m.estado = 'finalizado'", CONDICION_DURACION[filtros["tipo"]]] + condiciones
+    params["segundos"] = filtros["minutos"] * 60
+
+    return condiciones, params
+
+
 @movimiento_bp.route("/reportes/viajes-menores-10", methods=["GET"])
 @login_required
 def reporte_viajes_menores_10():
 
+    filtros = _filtros_viajes()
+    minutos = filtros["minutos"]
+    tipo = filtros["tipo"]
+
     try:
-        page = request.args.get("page", 1, type=int)
         per_page = 50
-        offset = (page - 1) * per_page
-
-        total_query = text("""
-            SELECT COUNT(*) AS total
-            FROM operacionbarco.movimientos_barco m
-            WHERE m.estado = 'finalizado'
-              AND m.hora_llegada IS NOT NULL
-              AND m.hora_salida IS NOT NULL
-              AND EXTRACT(EPOCH FROM (m.hora_llegada - m.hora_salida)) / 60 < 10
-        """)
+        cursor = _leer_cursor_llegada(request.args.get("antes"))
+        total = request.args.get("total", type=int) if cursor else None
+        mostrados = request.args.get("n", 0, type=int) if cursor else 0
 
-        data_query = text("""
-            SELECT
-                m.id,
-                p.numero_placa,
-                COALESCE(p.propietario, 'No registrado') AS chofer,
-                m.contenedor,
-                m.hora_salida,
-                m.hora_llegada,
-                ROUND(
-                    EXTRACT(EPOCH FROM (m.hora_llegada - m.hora_salida)) / 60,
-                    2
-                ) AS duracion_minutos,
-                COALESCE(u.nombre, u.email, 'No registrado') AS cerrado_por
-            FROM operacionbarco.movimientos_barco m
-            JOIN operacionbarco.placas p
-                ON p.id = m.placa_id
-            LEFT JOIN operacionbarco.usuarios u
-                ON u.id = m.cerrado_por_user_id
-            WHERE m.estado = 'finalizado'
-              AND m.hora_llegada IS NOT NULL
-              AND m.hora_salida IS NOT NULL
-              AND EXTRACT(EPOCH FROM (m.hora_llegada - m.hora_salida)) / 60 < 10
-            ORDER BY m.hora_llegada DESC
-            LIMIT :limit OFFSET :offset
-        """)
+        condiciones, params = _condiciones_viajes(filtros)
+        params["limit"] = per_page + 1
+
+        if cursor:
+            condiciones.append("(m.hora_llegada, m.id) < (:llegada, :cursor_id)")
+            params["llegada"], params["cursor_id"] = cursor
+
+        # Total en la misma consulta, solo cuando no viene en el enlace
+        contar = ", COUNT(*) OVER() AS total" if total is None else ""
+
+        data_query = text(
+            _VIAJES_POR_DURACION.format(
+                contar=contar,
+                condiciones=" AND ".join(condiciones),
+            )
+            + " LIMIT :limit"
+        )
+
+        filas = db.session.execute(data_query, params).mappings().all()
 
-        total = db.session.execute(total_query).scalar() or 0
+        registros, hay_mas, total = _paginar(filas, per_page, total)
 
-        registros = db.session.execute(
-            data_query,
-            {
-                "limit": per_page,
-                "offset": offset
-            }
-        ).mappings().all()
+        siguiente = None
 
-        pages = (total + per_page - 1) // per_page
+        if hay_mas:
+            ultima = registros[-1]
+            siguiente = f"{ultima['hora_llegada'].isoformat()}_{ultima['id']}"
 
         return render_template(
             "reporte_viajes_menores_10.html",
             registros=registros,
-            page=page,
-            pages=pages
+            siguiente=siguiente,
+            total=total,
+            mostrados=mostrados,
+            filtros=filtros,
+            operaciones=_operaciones_para_filtro(),
+            minutos=minutos,
+            tipo=tipo
         )
 
     except Exception as e:
+        db.session.rollback()
+
         current_app.logger.exception(
-            f"Error en reporte de viajes menores a 10 minutos: {e}"
+            f"Error en reporte de viajes por duración: {e}"
         )
 
         flash(
-            "Ocurrió un error al cargar el reporte de viajes menores a 10 minutos.",
+            "Ocurrió un error al cargar el reporte de viajes por duración.",
             "danger"
         )
 
         return render_template(
             "reporte_viajes_menores_10.html",
             registros=[],
-            page=1,
-            pages=0
+            siguiente=None,
+            total=0,
+            mostrados=0,
+            filtros=filtros,
+            operaciones=[],
+            minutos=minutos,
+            tipo=tipo
+        )
+
+
+# ============================================================
+# 📤 EXPORTAR REPORTES (XLSX / CSV en streaming)
+# ============================================================
+@movimiento_bp.route("/reportes/choferes-transito/exportar", methods=["GET"])
+@login_required
+def exportar_choferes_transito():
+
+    filtros = _filtros_reporte()
+
+    try:
+        agregado, params = _agregado_choferes(filtros)
+
+        filas = db.session.execute(
+            text(f"""
+                SELECT
+                    x.chofer,
+                    x.total_viajes,
+                    x.promedio_minutos,
+                    x.mayor_duracion_minutos,
+                    x.menor_duracion_minutos
+                FROM ({agregado}) x
+                {ORDEN_CHOFERES}
+            """),
+            params,
+            execution_options={"yield_per": FILAS_POR_TANDA},
+        )
+
+        return responder_exportacion(
+            request.args.get("formato"),
+            "choferes_transito",
+            "Choferes",
+            [
+                "Chofer",
+                "Total viajes",
+                "Promedio minutos",
+                "Mayor duración (min)",
+                "Menor duración (min)",
+            ],
+            [30, 14, 18, 20, 20],
+            filas,
+        )
+
+    except Exception as e:
+        db.session.rollback()
+
+        current_app.logger.exception(
+            f"Error exportando reporte de choferes en tránsito: {e}"
+        )
+
+        flash("❌ Ocurrió un error exportando el reporte.", "danger")
+
+        return redirect(
+            url_for("movimiento_bp.reporte_choferes_transito", **filtros)
+        )
+
+
+@movimiento_bp.route("/reportes/viajes-menores-10/exportar", methods=["GET"])
+@login_required
+def exportar_viajes_menores_10():
+
+    filtros = _filtros_viajes()
+
+    try:
+        condiciones, params = _condiciones_viajes(filtros)
+
+        filas = db.session.execute(
+            text(
+                _VIAJES_POR_DURACION.format(
+                    contar="",
+                    condiciones=" AND ".join(condiciones),
+                )
+            ),
+            params,
+            execution_options={"yield_per": FILAS_POR_TANDA},
+        )
+
+        return responder_exportacion(
+            request.args.get("formato"),
+            f"viajes_{filtros['tipo']}_{filtros['minutos']}min",
+            "Viajes",
+            [
+                "ID",
+                "Placa",
+                "Chofer",
+                "Identificador",
+                "Salida",
+                "Llegada",
+                "Duración (min)",
+                "Cerrado por",
+            ],
+            [10, 14, 30, 20, 20, 20, 16, 30],
+            filas,
+        )
+
+    except Exception as e:
+        db.session.rollback()
+
+        current_app.logger.exception(
+            f"Error exportando reporte de viajes por duración: {e}"
+        )
+
+        flash("❌ Ocurrió un error exportando el reporte.", "danger")
+
+        return redirect(
+            url_for("movimiento_bp.reporte_viajes_menores_10", **filtros)
         )
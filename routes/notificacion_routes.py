@@ -5,20 +5,42 @@ from flask import (
     current_app,
     render_template,
     make_response,
+    abort,
 )
 from flask_login import login_required, current_user
-from models.movimiento import MovimientoBarco
-from models.placa import Placa
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import joinedload
+from models.movimiento import MovimientoBarco, recalcular_vencimientos
 from models.base import db
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz
 import os
-from pywebpush import webpush, WebPushException
 import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 
 from models.push_subscription import PushSubscription
-from models.notificacion_alerta import NotificacionAlerta
-from models.tiempo import ConfigTiempos
+from models.notificacion_outbox import (
+    NotificacionOutbox,
+    encolar_notificacion,
+    encolar_notificaciones,
+)
+from models.circuitos import estado_circuitos
+from models.notificacion_alerta import (
+    NotificacionAlerta,
+    EnvioAlerta,
+    ultima_alerta,
+    anotar_ultima_alerta,
+    datos_alerta,
+    columnas_alerta,
+)
+from models.tiempo import tiempos_cache
+from models.operacion import Operacion
+from models.placa import Placa
+from models.programador import evaluacion_exclusiva
+from models.registro_viajes import registro_viajes, normalizar_tipo
 
 
 notificacion_bp = Blueprint(
@@ -29,16 +51,25 @@ notificacion_bp = Blueprint(
 
 CR_TZ = pytz.timezone("America/Costa_Rica")
 
+# Cada cuánto se recarga el registro de viajes completo desde BD, para
+# tomar movimientos creados o cerrados desde otro proceso.
+RECARGA_REGISTRO_SEGUNDOS = 120
 
-def _push_text(texto: str, max_len: int = 180) -> str:
-    t = (texto or "").replace("*", "")
-    t = t.replace("\r", "\n")
-    t = " ".join(t.split())
+# Entre recargas, cada cuánto el líder compara la firma de los viajes en
+# ruta (cantidad y suma de ids, una consulta) contra su registro: si otro
+# worker creó o cerró un viaje, recarga sin esperar la recarga periódica.
+REVISION_REGISTRO_SEGUNDOS = 5
 
-    if len(t) > max_len:
-        t = t[: max_len - 1] + "…"
+# Una alerta no cambia después de insertarse: su página se renderiza una
+# vez y el navegador la puede guardar un día. Las emergencias (incidentes)
+# suman avisos en sitio, así que viven 30 segundos; la "última", 5.
+MAX_ALERTAS_RENDERIZADAS = 500
+CACHE_ALERTA_SEGUNDOS = 24 * 60 * 60
+CACHE_INCIDENTE_SEGUNDOS = 30
+CACHE_ULTIMA_ALERTA_SEGUNDOS = 5
 
-    return t
+_renderizadas = OrderedDict()
+_renderizadas_lock = threading.Lock()
 
 
 def guardar_ultima_alerta(
@@ -46,119 +77,528 @@ def guardar_ultima_alerta(
     mensaje: str,
     tipo: str = "alerta",
     operacion_id=None,
-    movimiento_id=None
+    movimiento_id=None,
+    encolar_push: bool = True,
 ):
-    alerta_id = None
+    """
+    Registra la alerta y encola su push en la transacción actual.
+
+    No hace commit: la alerta se confirma junto con el cambio de estado que
+    la origina, y el despachador la entrega después del commit.
+    """
+    alerta = NotificacionAlerta(
+        tipo=(tipo or "alerta"),
+        titulo=titulo,
+        mensaje=mensaje,
+        fecha=datetime.now(CR_TZ).replace(tzinfo=None),
+        operacion_id=operacion_id,
+        movimiento_id=movimiento_id
+    )
 
-    try:
-        alerta = NotificacionAlerta(
-            tipo=(tipo or "alerta"),
-            titulo=titulo,
-            mensaje=mensaje,
-            fecha=datetime.now(CR_TZ).replace(tzinfo=None),
-            operacion_id=operacion_id,
-            movimiento_id=movimiento_id
+    db.session.add(alerta)
+    db.session.flush()
+
+    if encolar_push:
+        encolar_notificacion(
+            titulo,
+            mensaje,
+            url=f"/notificaciones/alerta/{alerta.id}",
+            alerta_id=alerta.id,
+        )
+
+    anotar_ultima_alerta(
+        alerta.id,
+        alerta.titulo,
+        alerta.mensaje,
+        alerta.fecha,
+        alerta.tipo,
+    )
+
+    return alerta.id
+
+
+def guardar_alertas(alertas, fecha=None) -> list:
+    """
+    Inserta varias alertas en un solo INSERT ... RETURNING (sin commit).
+    `alertas` son dicts con tipo, titulo, mensaje, operacion_id y
+    movimiento_id. Retorna los ids en el mismo orden.
+    """
+    if not alertas:
+        return []
+
+    fecha = fecha or datetime.now(CR_TZ).replace(tzinfo=None)
+
+    ids = db.session.execute(
+        db.insert(NotificacionAlerta).returning(
+            NotificacionAlerta.id,
+            sort_by_parameter_order=True,
+        ),
+        [{**a, "fecha": fecha} for a in alertas],
+    ).scalars().all()
+
+    ultima = alertas[-1]
+    anotar_ultima_alerta(
+        ids[-1],
+        ultima["titulo"],
+        ultima["mensaje"],
+        fecha,
+        ultima["tipo"],
+        ultima.get("conteo", 1),
+        ultima.get("primera_fecha"),
+    )
+
+    return ids
+
+
+def registrar_incidentes(vencidas, ahora) -> list:
+    """
+    Una emergencia por movimiento (incidente), actualizada en sitio.
+
+    Si el viaje ya tiene su incidente se le suma un aviso (fecha, conteo,
+    mensaje y minutos al día) con un UPDATE en lote; si no, se crea con
+    guardar_alertas(). Cada aviso queda además como una fila liviana en
+    notificaciones_alerta_envios. Sin commit. `vencidas` son dicts con
+    titulo, mensaje, operacion_id, movimiento_id y minutos; retorna los
+    ids de alerta en el mismo orden.
+    """
+    if not vencidas:
+        return []
+
+    previos = {}
+
+    for alerta_id, movimiento_id, conteo, primera_fecha, fecha in (
+        db.session.query(
+            NotificacionAlerta.id,
+            NotificacionAlerta.movimiento_id,
+            NotificacionAlerta.conteo,
+            NotificacionAlerta.primera_fecha,
+            NotificacionAlerta.fecha,
+        )
+        .filter(
+            NotificacionAlerta.tipo == "emergencia",
+            NotificacionAlerta.movimiento_id.in_(
+                [v["movimiento_id"] for v in vencidas]
+            ),
+        )
+    ):
+        # Historial previo a los incidentes: se continúa la más reciente
+        if movimiento_id not in previos or previos[movimiento_id][0] < alerta_id:
+            previos[movimiento_id] = (alerta_id, conteo or 1, primera_fecha or fecha)
+
+    nuevas = [v for v in vencidas if v["movimiento_id"] not in previos]
+    existentes = [v for v in vencidas if v["movimiento_id"] in previos]
+
+    if existentes:
+        tabla = NotificacionAlerta.__table__
+
+        db.session.execute(
+            tabla.update()
+            .where(tabla.c.id == db.bindparam("b_id"))
+            .values(
+                titulo=db.bindparam("b_titulo"),
+                mensaje=db.bindparam("b_mensaje"),
+                fecha=ahora,
+                primera_fecha=func.coalesce(tabla.c.primera_fecha, tabla.c.fecha),
+                conteo=tabla.c.conteo + 1,
+                minutos_transcurridos=db.bindparam("b_minutos"),
+            ),
+            [
+                {
+                    "b_id": previos[v["movimiento_id"]][0],
+                    "b_titulo": v["titulo"],
+                    "b_mensaje": v["mensaje"],
+                    "b_minutos": v["minutos"],
+                }
+                for v in existentes
+            ],
         )
 
-        db.session.add(alerta)
+    ids_nuevas = dict(zip(
+        [v["movimiento_id"] for v in nuevas],
+        guardar_alertas(
+            [
+                {
+                    "tipo": "emergencia",
+                    "titulo": v["titulo"],
+                    "mensaje": v["mensaje"],
+                    "operacion_id": v["operacion_id"],
+                    "movimiento_id": v["movimiento_id"],
+                    "primera_fecha": ahora,
+                    "conteo": 1,
+                    "minutos_transcurridos": v["minutos"],
+                }
+                for v in nuevas
+            ],
+            fecha=ahora,
+        ),
+    ))
+
+    ids = [
+        ids_nuevas.get(v["movimiento_id"]) or previos[v["movimiento_id"]][0]
+        for v in vencidas
+    ]
+
+    db.session.execute(
+        db.insert(EnvioAlerta),
+        [
+            {
+                "alerta_id": alerta_id,
+                "fecha": ahora,
+                "minutos_transcurridos": v["minutos"],
+            }
+            for v, alerta_id in zip(vencidas, ids)
+        ],
+    )
+
+    if existentes and not nuevas:
+        v = existentes[-1]
+        alerta_id, conteo, primera_fecha = previos[v["movimiento_id"]]
+
+        anotar_ultima_alerta(
+            alerta_id,
+            v["titulo"],
+            v["mensaje"],
+            ahora,
+            "emergencia",
+            conteo + 1,
+            primera_fecha,
+        )
+
+    return ids
+
+
+def revisar_orden_incorrecto(mov_cerrado) -> int:
+    """
+    Se llama al cerrar un movimiento, antes del commit: busca en la misma
+    operación los viajes que salieron antes y siguen en ruta, y registra una
+    sola alerta por cada uno, en la misma transacción del cierre.
+
+    Usa el índice (operacion_id, estado, hora_salida), así que el costo depende
+    de los viajes activos de la operación y no del historial completo.
+    """
+    if not mov_cerrado.hora_salida:
+        return 0
+
+    retrasados = (
+        MovimientoBarco.query
+        .options(joinedload(MovimientoBarco.placa))
+        .filter(
+            MovimientoBarco.operacion_id == mov_cerrado.operacion_id,
+            MovimientoBarco.estado == "en_ruta",
+            MovimientoBarco.id != mov_cerrado.id,
+            MovimientoBarco.hora_salida < mov_cerrado.hora_salida,
+            MovimientoBarco.alerta_orden_enviada.isnot(True),
+        )
+        .order_by(MovimientoBarco.hora_salida.asc())
+        .all()
+    )
+
+    placa_y = mov_cerrado.placa
+    total_alertas = 0
+
+    for mov_x in retrasados:
+        placa_x = mov_x.placa
+
+        if not placa_x or not placa_y:
+            continue
+
+        mensaje = (
+            "🚨 *ALERTA DE ORDEN INCORRECTO*\n\n"
+            "Un viaje salió antes y aún no ha llegado,\n"
+            "pero otro posterior ya fue cerrado.\n\n"
+            f"🚛 Placa retrasada: {placa_x.numero_placa}\n"
+            f"🎨 Color cabezal: {placa_x.color_cabezal or 'No registrado'}\n"
+            f"📦 Contenedor: {mov_x.contenedor}\n\n"
+            f"🚛 Placa que cerró antes: {placa_y.numero_placa}\n"
+            f"🎨 Color cabezal: {placa_y.color_cabezal or 'No registrado'}"
+        )
+
+        guardar_ultima_alerta(
+            "🚨 Orden incorrecto",
+            mensaje,
+            tipo="alerta",
+            operacion_id=mov_x.operacion_id,
+            movimiento_id=mov_x.id,
+        )
+
+        mov_x.alerta_orden_enviada = True
+        total_alertas += 1
+
+    return total_alertas
+
+
+def cargar_registro_viajes():
+    """Carga en el registro todos los viajes en ruta (solo columnas necesarias)."""
+    umbrales = tiempos_cache.obtener()
+
+    # Viajes en ruta sin vence_en (insertados por fuera de agregar_movimiento)
+    if recalcular_vencimientos(
+        umbrales.min_import,
+        umbrales.min_export,
+        solo_faltantes=True,
+    ):
         db.session.commit()
-        alerta_id = alerta.id
 
-    except Exception:
-        db.session.rollback()
-        current_app.logger.exception(
-            "No se pudo guardar alerta en PostgreSQL"
+    viajes = (
+        db.session.query(
+            MovimientoBarco.id,
+            MovimientoBarco.hora_salida,
+            MovimientoBarco.ultima_notificacion,
+            Operacion.tipo_operacion,
         )
+        .outerjoin(Operacion, Operacion.id == MovimientoBarco.operacion_id)
+        .filter(MovimientoBarco.estado == "en_ruta")
+        .all()
+    )
 
-    try:
-        ruta = os.path.join(current_app.root_path, "last_alert.json")
+    registro_viajes.cargar(
+        viajes,
+        umbrales.min_import,
+        umbrales.min_export,
+    )
 
-        data = {
-            "titulo": titulo,
-            "mensaje": mensaje,
-            "fecha": datetime.now(CR_TZ).strftime("%d/%m/%Y %H:%M:%S")
-        }
 
-        with open(ruta, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+def _mensaje_emergencia(viaje, umbral_min, tipo_label, tiempo_trans) -> str:
+    nombre_chofer = (
+        viaje.propietario
+        or "Chofer no registrado"
+    )
 
-    except Exception:
-        current_app.logger.exception(
-            "No se pudo guardar last_alert.json"
+    h, r = divmod(tiempo_trans.seconds, 3600)
+    m, s = divmod(r, 60)
+
+    return (
+        "🚨🚨🚨🚨🚨🚨🚨🚨🚨\n"
+        "*ALERTA DE EMERGENCIA*\n"
+        f"Un vehículo lleva *más de {umbral_min} minutos sin cerrarse*.\n\n"
+        f"📌 Tipo: {tipo_label}\n"
+        f"👤 Chofer: {nombre_chofer}\n"
+        f"🚛 Placa: {viaje.numero_placa}\n"
+        f"🎨 Color cabezal: {viaje.color_cabezal or 'No registrado'}\n"
+        f"📦 Identificador: {viaje.contenedor}\n"
+        f"🕒 Salida: {viaje.hora_salida.strftime('%d/%m/%Y %H:%M')}\n"
+        f"⏳ Tiempo: {h}h {m}m {s}s\n\n"
+        "⚠️ Revisar urgentemente."
+    )
+
+
+def consultar_viajes_vencidos(ahora):
+    """
+    Viajes en ruta cuya próxima alerta (vence_en) ya pasó, en una sola
+    consulta por rango sobre el índice parcial de viajes en ruta. Solo
+    vuelven las columnas que usa el mensaje.
+    """
+    return (
+        db.session.query(
+            MovimientoBarco.id,
+            MovimientoBarco.operacion_id,
+            MovimientoBarco.contenedor,
+            MovimientoBarco.hora_salida,
+            MovimientoBarco.vence_en,
+            Operacion.tipo_operacion,
+            Placa.numero_placa,
+            Placa.propietario,
+            Placa.color_cabezal,
         )
+        .join(Placa, Placa.id == MovimientoBarco.placa_id)
+        .outerjoin(Operacion, Operacion.id == MovimientoBarco.operacion_id)
+        .filter(
+            MovimientoBarco.estado == "en_ruta",
+            MovimientoBarco.vence_en <= ahora,
+        )
+        .order_by(MovimientoBarco.vence_en.asc())
+        .all()
+    )
 
-    return alerta_id
 
+def _encolar_digest(vencidas):
+    """
+    Un solo push por dispositivo para todos los viajes que vencieron en el
+    mismo tick. Cada alerta sigue guardada aparte para ver el detalle.
+    """
+    if len(vencidas) == 1:
+        v = vencidas[0]
 
-def enviar_push_mismo_mensaje(
-    mensaje: str,
-    titulo: str = "Operación Barco",
-    url: str = "/notificaciones/alerta",
-) -> dict:
-    try:
-        vapid_private = os.getenv("VAPID_PRIVATE_KEY", "")
-        vapid_subject = os.getenv("VAPID_SUBJECT", "mailto:ti@alamo.com")
+        encolar_notificacion(
+            v["titulo"],
+            v["mensaje"],
+            url=f"/notificaciones/alerta/{v['alerta_id']}",
+            alerta_id=v["alerta_id"],
+        )
+        return
 
-        if not vapid_private:
-            return {"enviados": 0, "fallidos": 0}
+    lineas = [
+        f"🚛 {v['placa']} · {v['tipo_label']} · {v['minutos']} min"
+        for v in vencidas[:10]
+    ]
 
-        subs = PushSubscription.query.all()
+    if len(vencidas) > 10:
+        lineas.append(f"… y {len(vencidas) - 10} más")
 
-        if not subs:
-            return {"enviados": 0, "fallidos": 0}
+    encolar_notificacion(
+        f"🚨 {len(vencidas)} viajes en emergencia",
+        "\n".join(lineas),
+        url="/notificaciones/alertas",
+    )
 
-        payload = json.dumps({
-            "title": titulo,
-            "body": _push_text(mensaje),
-            "url": url,
-        })
 
-        enviados = 0
-        fallidos = 0
+def registro_desactualizado() -> bool:
+    """True si los viajes en ruta en BD no coinciden con los del registro."""
+    cantidad, suma = (
+        db.session.query(
+            func.count(MovimientoBarco.id),
+            func.coalesce(func.sum(MovimientoBarco.id), 0),
+        )
+        .filter(
+            MovimientoBarco.estado == "en_ruta",
+            MovimientoBarco.hora_salida.isnot(None),
+        )
+        .one()
+    )
 
-        for s in subs:
-            sub_info = {
-                "endpoint": s.endpoint,
-                "keys": {
-                    "p256dh": s.p256dh,
-                    "auth": s.auth,
-                },
-            }
+    return (cantidad, suma) != registro_viajes.firma()
 
-            try:
-                webpush(
-                    subscription_info=sub_info,
-                    data=payload,
-                    vapid_private_key=vapid_private,
-                    vapid_claims={"sub": vapid_subject},
-                )
 
-                enviados += 1
-                s.last_seen = datetime.utcnow()
+def hay_viajes_por_evaluar(ahora) -> bool:
+    """
+    True si el registro tiene algo vencido o toca recargarlo.
 
-            except WebPushException:
-                fallidos += 1
+    El hilo líder lo consulta antes de tocar la BD; a lo sumo cada
+    REVISION_REGISTRO_SEGUNDOS compara la firma de los viajes en ruta para
+    ver los creados o cerrados en otro worker. Tiempos cambiados en otro
+    worker se ven, a más tardar, en la recarga periódica.
+    """
+    if (
+        registro_viajes.necesita_carga(RECARGA_REGISTRO_SEGUNDOS)
+        or registro_viajes.vencidos(ahora)
+    ):
+        return True
 
-                try:
-                    db.session.delete(s)
-                except Exception:
-                    pass
+    if (
+        registro_viajes.toca_revisar(REVISION_REGISTRO_SEGUNDOS)
+        and registro_desactualizado()
+    ):
+        registro_viajes.invalidar()
+        return True
 
-        db.session.commit()
+    return False
 
-        return {
-            "enviados": enviados,
-            "fallidos": fallidos
-        }
 
-    except Exception:
-        db.session.rollback()
-        current_app.logger.exception("Error enviando push")
+def evaluar_viajes_vencidos(ahora=None) -> int:
+    """
+    Envía las alertas de retraso de los viajes cuya próxima alerta ya venció.
+
+    El registro en memoria dice cuándo despertar; entonces una sola consulta
+    trae los viajes vencidos. Si nada venció, no hay ninguna consulta (salvo
+    la recarga periódica).
+    """
+    if registro_viajes.necesita_carga(RECARGA_REGISTRO_SEGUNDOS):
+        cargar_registro_viajes()
+    else:
+        # Tiempos cambiados desde otro worker: llegan por la versión del cache
+        umbrales = tiempos_cache.obtener()
+
+        if (
+            umbrales.min_import != registro_viajes.min_import
+            or umbrales.min_export != registro_viajes.min_export
+        ):
+            registro_viajes.configurar_umbrales(
+                umbrales.min_import,
+                umbrales.min_export,
+            )
+
+    ahora = ahora or datetime.now(CR_TZ).replace(tzinfo=None)
+
+    ids = registro_viajes.vencidos(ahora)
+
+    if not ids:
+        return 0
+
+    # El registro solo dice "ya hay algo vencido"; qué venció lo decide la
+    # BD (vence_en), así también entran viajes creados en otro proceso.
+    viajes = consultar_viajes_vencidos(ahora)
+
+    # Vencidos en el registro que la BD no devolvió: cerrados o notificados
+    # por otro proceso. Se revisan de nuevo en 4 minutos (o en la recarga).
+    for mov_id in set(ids) - {v.id for v in viajes}:
+        registro_viajes.marcar_notificado(mov_id, ahora)
+
+    if not viajes:
+        return 0
 
-        return {
-            "enviados": 0,
-            "fallidos": 0
-        }
+    # Todo el tick va en una transacción: CAS en lote, incidentes en lote,
+    # INSERT del outbox en lote y un commit. La entrega (push)
+    # la hace el despachador después del commit.
+    reclamados = MovimientoBarco.reclamar_notificaciones(
+        [v.id for v in viajes],
+        ahora,
+    )
+
+    digest = current_app.config.get("ALERTAS_DIGEST", True)
+    vencidas = []
+
+    for viaje in viajes:
+        if viaje.id not in reclamados:
+            continue
+
+        tipo = normalizar_tipo(viaje.tipo_operacion)
+        umbral_min = registro_viajes.umbral(tipo)
+        tiempo_trans = ahora - viaje.hora_salida
+
+        tipo_label = (
+            "IMPORTACIÓN"
+            if tipo == "importacion"
+            else "EXPORTACIÓN"
+        )
+
+        vencidas.append({
+            "titulo": f"🚨 Emergencia: {tipo_label}",
+            "mensaje": _mensaje_emergencia(
+                viaje,
+                umbral_min,
+                tipo_label,
+                tiempo_trans,
+            ),
+            "operacion_id": viaje.operacion_id,
+            "movimiento_id": viaje.id,
+            "tipo_label": tipo_label,
+            "placa": viaje.numero_placa,
+            "minutos": int(tiempo_trans.total_seconds() // 60),
+        })
+
+    alerta_ids = registrar_incidentes(vencidas, ahora)
+
+    for v, alerta_id in zip(vencidas, alerta_ids):
+        v["alerta_id"] = alerta_id
+
+    if digest:
+        if vencidas:
+            _encolar_digest(vencidas)
+    else:
+        encolar_notificaciones([
+            {
+                "titulo": v["titulo"],
+                "mensaje": v["mensaje"],
+                "url": f"/notificaciones/alerta/{v['alerta_id']}",
+                "alerta_id": v["alerta_id"],
+            }
+            for v in vencidas
+        ])
+
+    db.session.commit()
+
+    # Reclamado aquí o por otro proceso: el próximo intento es en 4 minutos
+    for viaje in viajes:
+        registro_viajes.registrar(
+            viaje.id,
+            viaje.hora_salida,
+            viaje.tipo_operacion,
+            ahora,
+        )
+
+    total_alertas = len(vencidas)
+
+    return total_alertas
 
 
 @notificacion_bp.route("/check", methods=["GET"])
@@ -174,288 +614,308 @@ def check():
     )
 
 
-@notificacion_bp.route("/alerta", methods=["GET"])
-def ver_alerta():
-    alerta = (
-        NotificacionAlerta.query
-        .order_by(NotificacionAlerta.id.desc())
-        .first()
+def _alerta_renderizada(datos: dict):
+    """
+    (html, etag) de la página de una alerta, renderizada una vez por
+    (id, conteo): un incidente que suma avisos se vuelve a renderizar.
+    """
+    clave = (datos["id"], datos["conteo"])
+
+    # Las emergencias pueden sumar avisos: se revalidan pasado un rato
+    revalidar_en = (
+        time.monotonic() + CACHE_INCIDENTE_SEGUNDOS
+        if datos["tipo"] == "emergencia"
+        else None
     )
 
-    if not alerta:
-        data = {
-            "titulo": "Sin alertas",
-            "mensaje": "No hay alertas registradas.",
-            "fecha": "",
-            "tipo": "alerta",
-        }
-    else:
-        data = {
-            "titulo": alerta.titulo,
-            "mensaje": alerta.mensaje,
-            "fecha": alerta.fecha.strftime("%d/%m/%Y %H:%M:%S") if alerta.fecha else "",
-            "tipo": alerta.tipo,
-        }
-
-    resp = make_response(
-        render_template("alerta_grande.html", **data)
+    with _renderizadas_lock:
+        cacheada = _renderizadas.get(datos["id"])
+
+        if cacheada and cacheada[0] == clave:
+            _renderizadas[datos["id"]] = (clave, cacheada[1], cacheada[2], revalidar_en)
+            _renderizadas.move_to_end(datos["id"])
+            return cacheada[1], cacheada[2]
+
+    html = render_template(
+        "alerta_grande.html",
+        titulo=datos["titulo"],
+        mensaje=datos["mensaje"],
+        fecha=datos["fecha"],
+        tipo=datos["tipo"],
+        conteo=datos["conteo"],
+        primera_fecha=datos["primera_fecha"],
     )
+    etag = hashlib.sha1(html.encode("utf-8")).hexdigest()
 
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"] = "no-cache"
+    with _renderizadas_lock:
+        _renderizadas[datos["id"]] = (clave, html, etag, revalidar_en)
 
-    return resp
+        while len(_renderizadas) > MAX_ALERTAS_RENDERIZADAS:
+            _renderizadas.popitem(last=False)
 
+    return html, etag
 
-@notificacion_bp.route("/alerta/<int:alerta_id>", methods=["GET"])
-def ver_alerta_por_id(alerta_id):
-    alerta = NotificacionAlerta.query.get_or_404(alerta_id)
 
-    data = {
-        "titulo": alerta.titulo,
-        "mensaje": alerta.mensaje,
-        "fecha": alerta.fecha.strftime("%d/%m/%Y %H:%M:%S") if alerta.fecha else "",
-        "tipo": alerta.tipo,
-    }
+def _respuesta_cacheable(html: str, etag: str, max_age: int, immutable: bool = False):
+    """Respuesta con ETag fuerte; si el navegador ya la tiene, 304 sin cuerpo."""
+    resp = make_response(html)
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = max_age
 
-    resp = make_response(
-        render_template("alerta_grande.html", **data)
-    )
+    if immutable:
+        resp.cache_control.immutable = True
 
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"] = "no-cache"
+    return resp.make_conditional(request)
 
-    return resp
 
+@notificacion_bp.route("/alerta", methods=["GET"])
+def ver_alerta():
+    alerta = ultima_alerta.obtener()
 
-@notificacion_bp.route("/alertas", methods=["GET"])
-def listar_alertas():
-    alertas = (
-        NotificacionAlerta.query
-        .order_by(NotificacionAlerta.id.desc())
-        .limit(200)
-        .all()
-    )
+    if not alerta:
+        resp = make_response(
+            render_template(
+                "alerta_grande.html",
+                titulo="Sin alertas",
+                mensaje="No hay alertas registradas.",
+                fecha="",
+                tipo="alerta",
+            )
+        )
+        resp.cache_control.public = True
+        resp.cache_control.max_age = CACHE_ULTIMA_ALERTA_SEGUNDOS
+        return resp
 
-    return render_template(
-        "alertas_lista.html",
-        alertas=alertas
-    )
+    html, etag = _alerta_renderizada(alerta)
 
+    return _respuesta_cacheable(html, etag, CACHE_ULTIMA_ALERTA_SEGUNDOS)
 
-@notificacion_bp.route("/test", methods=["POST"])
-@login_required
-def test_notificacion():
-    data = request.get_json() or {}
-    mensaje = data.get("mensaje", "🧪 Prueba desde Operación Barco")
 
-    alerta_id = guardar_ultima_alerta(
-        "🧪 Prueba de notificación",
-        mensaje,
-        tipo="prueba",
-    )
+@notificacion_bp.route("/alerta/<int:alerta_id>", methods=["GET"])
+def ver_alerta_por_id(alerta_id):
+    with _renderizadas_lock:
+        cacheada = _renderizadas.get(alerta_id)
 
-    url_alerta = (
-        f"/notificaciones/alerta/{alerta_id}"
-        if alerta_id
-        else "/notificaciones/alerta"
-    )
+    if cacheada and (cacheada[3] is None or cacheada[3] > time.monotonic()):
+        html, etag = cacheada[1], cacheada[2]
+        es_incidente = cacheada[3] is not None
+    else:
+        fila = (
+            db.session.query(*columnas_alerta())
+            .filter(NotificacionAlerta.id == alerta_id)
+            .first()
+        )
 
-    push_result = enviar_push_mismo_mensaje(
-        mensaje,
-        "🧪 Prueba de notificación",
-        url=url_alerta
+        if not fila:
+            abort(404)
+
+        datos = datos_alerta(*fila)
+        html, etag = _alerta_renderizada(datos)
+        es_incidente = datos["tipo"] == "emergencia"
+
+    if es_incidente:
+        return _respuesta_cacheable(html, etag, CACHE_INCIDENTE_SEGUNDOS)
+
+    return _respuesta_cacheable(
+        html,
+        etag,
+        CACHE_ALERTA_SEGUNDOS,
+        immutable=True,
     )
 
-    return jsonify({
-        "ok": True,
-        "alerta_id": alerta_id,
-        **push_result
-    }), 200
 
+ALERTAS_POR_PAGINA = 50
+MAX_ALERTAS_FEED = 100
+TIPOS_ALERTA = ("alerta", "emergencia", "resuelta", "prueba")
 
-@notificacion_bp.route("/emergencia", methods=["GET"])
-def alerta_emergencia():
-    try:
-        ahora = datetime.now(CR_TZ).replace(tzinfo=None)
-        total_alertas = 0
 
-        cfg = (
-            ConfigTiempos.query
-            .order_by(ConfigTiempos.id.desc())
-            .first()
-        )
+def _filtros_alertas():
+    """Filtros del historial tomados del query string (solo los que vienen)."""
+    filtros = {}
 
-        min_import = int(getattr(cfg, "min_import", 20)) if cfg else 20
-        min_export = int(getattr(cfg, "min_export", 20)) if cfg else 20
+    tipo = (request.args.get("tipo") or "").strip().lower()
 
-        movimientos = (
-            MovimientoBarco.query
-            .filter_by(estado="en_ruta")
-            .all()
-        )
+    if tipo in TIPOS_ALERTA:
+        filtros["tipo"] = tipo
 
-        for mov in movimientos:
-            if not mov.hora_salida:
-                continue
+    for campo in ("operacion_id", "movimiento_id"):
+        valor = request.args.get(campo, type=int)
 
-            tipo = ""
+        if valor:
+            filtros[campo] = valor
 
-            try:
-                tipo = (
-                    mov.operacion.tipo_operacion or ""
-                ).strip().lower()
-            except Exception:
-                tipo = ""
+    return filtros
 
-            if tipo not in ["importacion", "exportacion"]:
-                tipo = "exportacion"
 
-            umbral_min = (
-                min_import
-                if tipo == "importacion"
-                else min_export
-            )
+def _consulta_alertas(filtros):
+    """Columnas compactas (el mensaje solo como resumen) con los filtros aplicados."""
+    consulta = db.session.query(
+        NotificacionAlerta.id,
+        NotificacionAlerta.tipo,
+        NotificacionAlerta.titulo,
+        NotificacionAlerta.fecha,
+        NotificacionAlerta.operacion_id,
+        NotificacionAlerta.movimiento_id,
+        NotificacionAlerta.conteo,
+        func.substr(NotificacionAlerta.mensaje, 1, 141).label("resumen"),
+    )
 
-            tiempo_trans = ahora - mov.hora_salida
+    for campo, valor in filtros.items():
+        consulta = consulta.filter(getattr(NotificacionAlerta, campo) == valor)
 
-            if tiempo_trans < timedelta(minutes=umbral_min):
-                continue
+    return consulta
 
-            if mov.ultima_notificacion:
-                if (ahora - mov.ultima_notificacion) < timedelta(minutes=4):
-                    continue
 
-            placa = Placa.query.get(mov.placa_id)
+def _leer_cursor(valor):
+    """Cursor "<fecha ISO>_<id>" de la página anterior, o None."""
+    try:
+        fecha, alerta_id = (valor or "").rsplit("_", 1)
+        return datetime.fromisoformat(fecha), int(alerta_id)
+    except ValueError:
+        return None
 
-            if not placa:
-                continue
 
-            nombre_chofer = (
-                placa.propietario
-                or "Chofer no registrado"
-            )
+@notificacion_bp.route("/alertas", methods=["GET"])
+def listar_alertas():
+    filtros = _filtros_alertas()
+    cursor = _leer_cursor(request.args.get("antes"))
 
-            h, r = divmod(tiempo_trans.seconds, 3600)
-            m, s = divmod(r, 60)
+    consulta = _consulta_alertas(filtros)
 
-            tipo_label = (
-                "IMPORTACIÓN"
-                if tipo == "importacion"
-                else "EXPORTACIÓN"
-            )
+    # Keyset: las siguientes después de la última que se mostró
+    if cursor:
+        consulta = consulta.filter(
+            tuple_(NotificacionAlerta.fecha, NotificacionAlerta.id) < tuple_(*cursor)
+        )
 
-            mensaje = (
-                "🚨🚨🚨🚨🚨🚨🚨🚨🚨\n"
-                "*ALERTA DE EMERGENCIA*\n"
-                f"Un vehículo lleva *más de {umbral_min} minutos sin cerrarse*.\n\n"
-                f"📌 Tipo: {tipo_label}\n"
-                f"👤 Chofer: {nombre_chofer}\n"
-                f"🚛 Placa: {placa.numero_placa}\n"
-                f"🎨 Color cabezal: {placa.color_cabezal or 'No registrado'}\n"
-                f"📦 Identificador: {mov.contenedor}\n"
-                f"🕒 Salida: {mov.hora_salida.strftime('%d/%m/%Y %H:%M')}\n"
-                f"⏳ Tiempo: {h}h {m}m {s}s\n\n"
-                "⚠️ Revisar urgentemente."
-            )
+    filas = (
+        consulta
+        .order_by(
+            NotificacionAlerta.fecha.desc(),
+            NotificacionAlerta.id.desc(),
+        )
+        .limit(ALERTAS_POR_PAGINA + 1)
+        .all()
+    )
 
-            alerta_id = guardar_ultima_alerta(
-                f"🚨 Emergencia: {tipo_label}",
-                mensaje,
-                tipo="emergencia",
-                operacion_id=getattr(mov, "operacion_id", None),
-                movimiento_id=mov.id,
-            )
+    alertas = filas[:ALERTAS_POR_PAGINA]
+    siguiente = None
 
-            url_alerta = (
-                f"/notificaciones/alerta/{alerta_id}"
-                if alerta_id
-                else "/notificaciones/alerta"
-            )
+    if len(filas) > ALERTAS_POR_PAGINA:
+        ultima = alertas[-1]
+        siguiente = f"{ultima.fecha.isoformat()}_{ultima.id}"
 
-            enviar_push_mismo_mensaje(
-                mensaje,
-                f"🚨 Emergencia: {tipo_label}",
-                url=url_alerta
-            )
+    return render_template(
+        "alertas_lista.html",
+        alertas=alertas,
+        filtros=filtros,
+        tipos=TIPOS_ALERTA,
+        siguiente=siguiente,
+        es_primera=cursor is None,
+    )
 
-            mov.ultima_notificacion = ahora
-            total_alertas += 1
 
-        todos = (
-            MovimientoBarco.query
-            .filter(
-                MovimientoBarco.hora_salida.isnot(None)
-            )
-            .all()
-        )
+@notificacion_bp.route("/api/alertas", methods=["GET"])
+def feed_alertas():
+    """
+    Alertas más nuevas que `since_id`, en orden ascendente (para pantallas
+    que consultan seguido). Si no hay nada nuevo no toca la BD.
+    """
+    since_id = request.args.get("since_id", 0, type=int)
+    filtros = _filtros_alertas()
 
-        orden_salida = sorted(
-            todos,
-            key=lambda m: m.hora_salida
-        )
+    # Id más alto, no el de la última por fecha (un incidente re-notificado
+    # es "el último" con un id viejo)
+    ultimo_id = ultima_alerta.ultimo_id()
 
-        for i in range(len(orden_salida)):
-            mov_x = orden_salida[i]
+    if since_id >= ultimo_id:
+        return jsonify({"alertas": [], "ultimo_id": max(since_id, ultimo_id)})
 
-            if mov_x.estado != "en_ruta":
-                continue
+    filas = (
+        _consulta_alertas(filtros)
+        .filter(NotificacionAlerta.id > since_id)
+        .order_by(NotificacionAlerta.id.asc())
+        .limit(MAX_ALERTAS_FEED)
+        .all()
+    )
 
-            for j in range(i + 1, len(orden_salida)):
-                mov_y = orden_salida[j]
+    return jsonify({
+        "alertas": [
+            {
+                "id": a.id,
+                "tipo": a.tipo,
+                "titulo": a.titulo,
+                "fecha": a.fecha.strftime("%d/%m/%Y %H:%M:%S") if a.fecha else "",
+                "operacion_id": a.operacion_id,
+                "movimiento_id": a.movimiento_id,
+                "conteo": a.conteo,
+                "resumen": a.resumen,
+                "url": f"/notificaciones/alerta/{a.id}",
+            }
+            for a in filas
+        ],
+        # Si no se llenó el límite, ya se revisó todo hasta la última alerta
+        "ultimo_id": (
+            filas[-1].id
+            if len(filas) == MAX_ALERTAS_FEED
+            else max([ultimo_id] + [a.id for a in filas[-1:]])
+        ),
+    })
 
-                if mov_y.hora_llegada and not mov_x.hora_llegada:
-                    if mov_x.alerta_orden_enviada:
-                        continue
 
-                    placa_x = Placa.query.get(mov_x.placa_id)
-                    placa_y = Placa.query.get(mov_y.placa_id)
+@notificacion_bp.route("/test", methods=["POST"])
+@login_required
+def test_notificacion():
+    data = request.get_json() or {}
+    mensaje = data.get("mensaje", "🧪 Prueba desde Operación Barco")
 
-                    if not placa_x or not placa_y:
-                        continue
+    try:
+        alerta_id = guardar_ultima_alerta(
+            "🧪 Prueba de notificación",
+            mensaje,
+            tipo="prueba",
+        )
 
-                    mensaje = (
-                        "🚨 *ALERTA DE ORDEN INCORRECTO*\n\n"
-                        "Un viaje salió antes y aún no ha llegado,\n"
-                        "pero otro posterior ya fue cerrado.\n\n"
-                        f"🚛 Placa retrasada: {placa_x.numero_placa}\n"
-                        f"🎨 Color cabezal: {placa_x.color_cabezal or 'No registrado'}\n"
-                        f"📦 Contenedor: {mov_x.contenedor}\n\n"
-                        f"🚛 Placa que cerró antes: {placa_y.numero_placa}\n"
-                        f"🎨 Color cabezal: {placa_y.color_cabezal or 'No registrado'}"
-                    )
+        db.session.commit()
 
-                    alerta_id = guardar_ultima_alerta(
-                        "🚨 Orden incorrecto",
-                        mensaje,
-                        tipo="alerta",
-                        operacion_id=getattr(mov_x, "operacion_id", None),
-                        movimiento_id=mov_x.id,
-                    )
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception(
+            "Error registrando notificación de prueba"
+        )
 
-                    url_alerta = (
-                        f"/notificaciones/alerta/{alerta_id}"
-                        if alerta_id
-                        else "/notificaciones/alerta"
-                    )
+        return jsonify({
+            "ok": False,
+            "error": "No se pudo registrar la prueba"
+        }), 500
 
-                    enviar_push_mismo_mensaje(
-                        mensaje,
-                        "🚨 Orden incorrecto",
-                        url=url_alerta
-                    )
+    return jsonify({
+        "ok": True,
+        "alerta_id": alerta_id,
+        "encolado": True,
+    }), 200
 
-                    mov_x.alerta_orden_enviada = True
-                    total_alertas += 1
 
-        db.session.commit()
+@notificacion_bp.route("/emergencia", methods=["GET"])
+def alerta_emergencia():
+    try:
+        ahora = datetime.now(CR_TZ).replace(tzinfo=None)
+
+        # Si el evaluador (u otro llamado) ya está corriendo, no duplicamos
+        with evaluacion_exclusiva() as turno:
+            total_alertas = (
+                evaluar_viajes_vencidos(ahora)
+                if turno
+                else 0
+            )
 
         return jsonify({
-            "status": "ok",
+            "status": "ok" if turno else "en_curso",
             "alertas_enviadas": total_alertas,
             "timestamp": ahora.strftime("%d/%m/%Y %H:%M:%S"),
-            "min_import": min_import,
-            "min_export": min_export,
+            "min_import": registro_viajes.min_import,
+            "min_export": registro_viajes.min_export,
         })
 
     except Exception as e:
@@ -584,6 +1044,33 @@ def push_status():
         })
 
 
+@notificacion_bp.route("/api/circuitos", methods=["GET"])
+@login_required
+def estado_de_circuitos():
+    """Circuit breakers de los canales de entrega (de este proceso)."""
+    if getattr(current_user, "rol", None) != "Admin":
+        return jsonify({"error": "No autorizado"}), 403
+
+    pendientes = (
+        db.session.query(
+            NotificacionOutbox.canal,
+            NotificacionOutbox.origen,
+            func.count(NotificacionOutbox.id),
+        )
+        .filter(NotificacionOutbox.estado.in_(("pendiente", "enviando")))
+        .group_by(NotificacionOutbox.canal, NotificacionOutbox.origen)
+        .all()
+    )
+
+    return jsonify({
+        "circuitos": estado_circuitos(),
+        "outbox_pendiente": [
+            {"canal": canal, "origen": origen, "cantidad": cantidad}
+            for canal, origen, cantidad in pendientes
+        ],
+    })
+
+
 @notificacion_bp.route("/api/push/send", methods=["POST"])
 @login_required
 def push_send():
@@ -591,14 +1078,17 @@ def push_send():
         data = request.get_json() or {}
         mensaje = data.get("mensaje", "🔔 Push de prueba")
 
-        r = enviar_push_mismo_mensaje(
+        item = encolar_notificacion(
+            "Operación Barco",
             mensaje,
-            "Operación Barco"
         )
 
+        db.session.commit()
+
         return jsonify({
             "status": "ok",
-            **r
+            "encolado": True,
+            "outbox_id": item.id,
         })
 
     except Exception:
@@ -8,6 +8,12 @@ from models.base import db
 from models.operacion import Operacion
 from models.movimiento import MovimientoBarco
 from models.placa import Placa
+from models.usuario import Usuario
+from models.exportacion import responder_exportacion, FILAS_POR_TANDA
+from models.registro_viajes import registro_viajes, calcular_vencimiento
+from models.resumen_transito import sumar_viaje_al_resumen
+from models.tiempo import tiempos_cache
+from routes.notificacion_routes import revisar_orden_incorrecto
 
 
 CR_TZ = pytz.timezone("America/Costa_Rica")
@@ -116,6 +122,90 @@ def detalle_operacion(operacion_id):
         return redirect(url_for("operacion_bp.listar_operaciones"))
 
 
+# ------------------------------------------------------------
+# 📤 Exportar movimientos de una operación (XLSX / CSV)
+#     Streaming: filas por tandas, sin cargar todo el historial
+# ------------------------------------------------------------
+@operacion_bp.route("/<int:operacion_id>/exportar", methods=["GET"])
+@login_required
+def exportar_movimientos_operacion(operacion_id):
+    operacion = Operacion.query.get_or_404(operacion_id)
+
+    try:
+        consulta = (
+            db.session.query(
+                MovimientoBarco.id,
+                MovimientoBarco.contenedor,
+                Placa.numero_placa,
+                Placa.propietario,
+                Placa.color_cabezal,
+                MovimientoBarco.estado,
+                MovimientoBarco.hora_salida,
+                MovimientoBarco.hora_llegada,
+                MovimientoBarco.duracion_segundos,
+                db.func.coalesce(Usuario.nombre, Usuario.email),
+            )
+            .join(Placa, Placa.id == MovimientoBarco.placa_id)
+            .outerjoin(Usuario, Usuario.id == MovimientoBarco.cerrado_por_user_id)
+            .filter(MovimientoBarco.operacion_id == operacion.id)
+            .order_by(MovimientoBarco.hora_salida.asc(), MovimientoBarco.id.asc())
+            .yield_per(FILAS_POR_TANDA)
+        )
+
+        filas = (
+            (
+                mov_id,
+                contenedor,
+                numero_placa,
+                propietario or "",
+                color_cabezal or "",
+                estado,
+                hora_salida,
+                hora_llegada,
+                round(duracion / 60, 2) if duracion is not None else None,
+                cerrado_por or "",
+            )
+            for (
+                mov_id,
+                contenedor,
+                numero_placa,
+                propietario,
+                color_cabezal,
+                estado,
+                hora_salida,
+                hora_llegada,
+                duracion,
+                cerrado_por,
+            ) in consulta
+        )
+
+        return responder_exportacion(
+            request.args.get("formato"),
+            f"movimientos_operacion_{operacion.id}",
+            "Movimientos",
+            [
+                "ID",
+                "Identificador",
+                "Placa",
+                "Chofer",
+                "Color Cabezal",
+                "Estado",
+                "Salida",
+                "Llegada",
+                "Duración (min)",
+                "Cerrado por",
+            ],
+            [10, 20, 14, 30, 16, 14, 20, 20, 16, 30],
+            filas,
+        )
+
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception(f"Error al exportar movimientos de la operación: {e}")
+        flash("❌ Ocurrió un error exportando los movimientos.", "danger")
+        return redirect(url_for("operacion_bp.detalle_operacion", operacion_id=operacion_id))
+
+
 # ------------------------------------------------------------
 # 🚛 4️⃣ Agregar movimiento (SALIDA) — SIN NOTIFICACIÓN
 #     ✅ AHORA: solo con IDENTIFICADOR FIJO (sin escribir contenedor)
@@ -152,18 +242,36 @@ def agregar_movimiento(operacion_id):
             flash(f"El identificador {identificador} ya está en ruta en esta operación.", "warning")
             return redirect(url_for("operacion_bp.detalle_operacion", operacion_id=operacion_id))
 
+        hora_salida = datetime.now(CR_TZ).replace(tzinfo=None)
+        operacion = Operacion.query.get(operacion_id)
+        tipo_operacion = getattr(operacion, "tipo_operacion", "")
+        umbrales = tiempos_cache.obtener()
+
         nuevo_mov = MovimientoBarco(
             operacion_id=operacion_id,
             placa_id=placa.id,
             contenedor=identificador,  # 👈 aquí va el identificador fijo
-            hora_salida=datetime.now(CR_TZ).replace(tzinfo=None),
+            hora_salida=hora_salida,
             estado="en_ruta",
             ultima_notificacion=None,
+            vence_en=calcular_vencimiento(
+                hora_salida,
+                tipo_operacion,
+                None,
+                umbrales.min_import,
+                umbrales.min_export,
+            ),
         )
 
         db.session.add(nuevo_mov)
         db.session.commit()
 
+        registro_viajes.registrar(
+            nuevo_mov.id,
+            nuevo_mov.hora_salida,
+            tipo_operacion,
+        )
+
         flash(f"Movimiento agregado correctamente para el identificador {identificador}.", "success")
         return redirect(url_for("operacion_bp.detalle_operacion", operacion_id=operacion_id))
 
@@ -243,12 +351,46 @@ def finalizar_movimiento(movimiento_id):
         # ✅ FINALIZAR MOVIMIENTO
         # ====================================================
 
-        mov.hora_llegada = hora_llegada
-        mov.estado = "finalizado"
-        mov.cerrado_por_user_id = current_user.id
+        # Solo el cierre que gana suma al resumen y revisa el orden
+        if not mov.cerrar(hora_llegada, current_user.id):
+            db.session.rollback()
+
+            flash(
+                "Ese movimiento ya fue finalizado.",
+                "warning"
+            )
+
+            return redirect(
+                url_for(
+                    "operacion_bp.detalle_operacion",
+                    operacion_id=mov.operacion_id
+                )
+            )
+
+        # Alertas de orden incorrecto y resumen del reporte de choferes en
+        # la misma transacción, cada uno en un savepoint: si fallan, el
+        # cierre igual se guarda (el resumen se rehace con el comando
+        # `flask reconstruir-resumen-transito`)
+        try:
+            with db.session.begin_nested():
+                revisar_orden_incorrecto(mov)
+        except Exception as e:
+            current_app.logger.exception(
+                f"Error revisando orden incorrecto del movimiento {mov.id}: {e}"
+            )
+
+        try:
+            with db.session.begin_nested():
+                sumar_viaje_al_resumen(mov)
+        except Exception as e:
+            current_app.logger.exception(
+                f"Error sumando el movimiento {mov.id} al resumen: {e}"
+            )
 
         db.session.commit()
 
+        registro_viajes.quitar(mov.id)
+
         flash(
             (
                 f"Movimiento {mov.contenedor} "
@@ -323,7 +465,13 @@ def debug_noti():
 
 @operacion_bp.route("/noti-test")
 def noti_test():
-    from models.notificacion import enviar_notificacion
+    from models.notificacion_outbox import encolar_notificacion
+
+    item = encolar_notificacion(
+        "Prueba WhatsApp",
+        "🔥 Notificación de prueba Operación Barco",
+        canal="whatsapp",
+    )
+    db.session.commit()
 
-    ok = enviar_notificacion("🔥 Notificación de prueba Operación Barco")
-    return {"resultado": ok}
+    return {"resultado": "encolado", "outbox_id": item.id}
@@ -1,8 +1,12 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_required, current_user
 
+from datetime import datetime
+
 from models.base import db
-from models.tiempo import ConfigTiempos
+from models.tiempo import ConfigTiempos, tiempos_cache
+from models.movimiento import recalcular_vencimientos
+from models.registro_viajes import registro_viajes
 
 tiempos_bp = Blueprint("tiempos_bp", __name__, url_prefix="/tiempos")
 
@@ -54,9 +58,18 @@ def guardar_tiempos():
         cfg.min_import = min_import
         cfg.min_export = min_export
         cfg.updated_by = current_user.id
+        cfg.updated_at = datetime.utcnow()
+        cfg.version = (cfg.version or 1) + 1
+
+        # Los viajes en ruta vencen según los nuevos umbrales
+        recalcular_vencimientos(min_import, min_export)
 
         db.session.commit()
 
+        # Este proceso ve el cambio al instante; los demás por la versión
+        tiempos_cache.invalidar()
+        registro_viajes.configurar_umbrales(min_import, min_export)
+
         flash("✅ Tiempos de notificación actualizados.", "success")
         return redirect(url_for("tiempos_bp.ver_tiempos"))
 